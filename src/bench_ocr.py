@@ -0,0 +1,70 @@
+import argparse
+import glob
+import os
+import time
+
+import cv2
+
+from ocr_engine import PytesseractEngine, TesserocrEngine, tesserocr
+
+# Compares ROIs/second of the tesseract subprocess path (pytesseract) against the
+# persistent in-process engine (tesserocr) on a folder of ROI images, e.g. the
+# roi_N.png files dumped when NFE_OCR_DEBUG_DIR is set.
+#
+#   python3 src/bench_ocr.py ./debug/SP_invoice --repeat 3
+
+
+def loadRois(paths):
+    rois = []
+    for path in paths:
+        for file in sorted(glob.glob(os.path.join(path, 'roi_*.png'))) if os.path.isdir(path) else [path]:
+            img = cv2.imread(file, 0)
+            if img is not None:
+                rois.append(img)
+    return rois
+
+
+def runBackend(engine, rois, repeat):
+    texts = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        texts = [engine.imageToString(roi) for roi in rois]
+    elapsed = time.perf_counter() - start
+    return texts, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark OCR backends on ROI images')
+    parser.add_argument('paths', nargs='+', help='ROI PNG files or folders containing them')
+    parser.add_argument('--repeat', type=int, default=1, help='How many times every ROI is transcribed')
+    args = parser.parse_args()
+
+    rois = loadRois(args.paths)
+    if len(rois) == 0:
+        print('No ROI images found')
+        return
+
+    engines = [PytesseractEngine]
+    if tesserocr is not None:
+        engines.append(TesserocrEngine)
+    else:
+        print('tesserocr is not installed, only the subprocess backend will be measured')
+
+    results = {}
+    for engine_cls in engines:
+        init_start = time.perf_counter()
+        engine = engine_cls()
+        init_time = time.perf_counter() - init_start
+        texts, elapsed = runBackend(engine, rois, args.repeat)
+        engine.close()
+        results[engine_cls.name] = texts
+        rate = len(rois) * args.repeat / elapsed if elapsed > 0 else float('inf')
+        print(fr'{engine_cls.name:<12} init {init_time:7.3f}s  ocr {elapsed:8.3f}s  {rate:8.2f} ROIs/s')
+
+    if len(results) == 2:
+        same = sum(1 for a, b in zip(results['pytesseract'], results['tesserocr']) if a.strip() == b.strip())
+        print(fr'Identical transcriptions: {same}/{len(rois)}')
+
+
+if __name__ == "__main__":
+    main()
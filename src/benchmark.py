@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+# Reproducible benchmark of the whole pipeline on synthetic RJ and SP NFS-e.
+#
+#   python3 src/benchmark.py --count 20 --dpis 300,500 --workers 1,4 --output bench.json
+#   python3 src/benchmark.py --count 20 --baseline bench.json --output bench_new.json
+#   python3 src/benchmark.py --count 20 --preprocess fixed,adaptive
+#
+# The fixtures are generated from --seed with the labels normalizeRJData/normalizeSPData look
+# for and known values (ground_truth.json). They are raster PDFs like scanned invoices, so
+# every run goes through rasterize + table detection + OCR. Every (dpi, workers, preprocess)
+# configuration runs in its own interpreter, so NFE_OCR_DPI and the OCR mode settings apply
+# and peak RSS is measured per run.
+
+PAGE_DPI = 250
+PAGE_SIZE = (2067, 2923)
+MARGIN = 80
+CELL_HEIGHT = 170
+
+# Environment of every --preprocess mode; NFE_OCR_ROI_PREPROCESS only applies to the single pass
+PREPROCESS_MODES = {
+    'tiered': {'NFE_OCR_TIERED': '1'},
+    'fixed': {'NFE_OCR_TIERED': '0', 'NFE_OCR_ROI_PREPROCESS': 'fixed'},
+    'adaptive': {'NFE_OCR_TIERED': '0', 'NFE_OCR_ROI_PREPROCESS': 'adaptive'},
+}
+
+
+def loadFont(size):
+    for name in ('DejaVuSans.ttf', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def formatMoney(cents):
+    units = fr'{cents // 100:,}'.replace(',', '.')
+    return fr'{units},{cents % 100:02d}'
+
+
+def commonValues(rng):
+    return {
+        'invoice_num': fr'{rng.randint(1, 99999999):08d}',
+        'invoice_creation': fr'{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(2019, 2024)} '
+                            fr'{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}',
+        'invoice_verif_cod': fr'{rng.randint(0, 0xFFFF):04X}-{rng.randint(0, 0xFFFF):04X}',
+        'doc_number': fr'{rng.randint(10, 99)}.{rng.randint(100, 999)}.{rng.randint(100, 999)}/0001-{rng.randint(10, 99)}',
+    }
+
+
+def spLayout(rng):
+    values = commonValues(rng)
+    total = rng.randint(100000, 5000000)
+    iss = total * 5 // 100
+    cells = [
+        [('Número da Nota', values['invoice_num']), ('Data e Hora de Emissão', values['invoice_creation']),
+         ('Código de Verificação', values['invoice_verif_cod'])],
+        [('PRESTADOR DE SERVIÇOS', fr'CPF/CNPJ: {values["doc_number"]} Inscrição Municipal: {rng.randint(1000000, 9999999)}\n'
+                                   'Nome/Razão Social: EMPRESA SINTETICA LTDA\nEndereço: RUA DAS FLORES 100 CEP: 01001-000\n'
+                                   'Município: São Paulo UF: SP')],
+        [('TOMADOR DE SERVIÇOS', 'Nome/Razão Social: CLIENTE SINTETICO SA\nCPF/CNPJ: 11.222.333/0001-44 Inscrição Municipal: 1234567\n'
+                                 'Endereço: AV PAULISTA 1000 CEP: 01310-100\nMunicípio: São Paulo UF: SP E-mail: nfe@cliente.com.br')],
+        [('VALOR TOTAL DO SERVIÇO = R$ ' + formatMoney(total), '')],
+        [('INSS (R$)', '0,00'), ('IRRF (R$)', '0,00'), ('CSLL (R$)', '0,00'), ('COFINS (R$)', '0,00')],
+        [('Base de Cálculo (R$)', formatMoney(total)), ('Aliquota (%)', '5,00%'), ('Valor do ISS (R$)', formatMoney(iss))],
+    ]
+    truth = {
+        'invoice_num': values['invoice_num'],
+        'invoice_creation': values['invoice_creation'],
+        'invoice_verif_cod': values['invoice_verif_cod'],
+        'invoice_value_raw': formatMoney(total),
+        'invoice_tax_calc_base': formatMoney(total),
+        'invoice_tax_iss': formatMoney(iss),
+    }
+    return 'PREFEITURA DO MUNICÍPIO DE SÃO PAULO', cells, truth
+
+
+def rjLayout(rng):
+    values = commonValues(rng)
+    total = rng.randint(100000, 5000000)
+    iss = total * 5 // 100
+    cells = [
+        [('Número da Nota', values['invoice_num']), ('Data e Hora de Emissão', values['invoice_creation']),
+         ('Código de Verificação', values['invoice_verif_cod'])],
+        [('PRESTADOR DE SERVIÇOS', fr'CPF/CNPJ: {values["doc_number"]} Inscrição Municipal: {rng.randint(1000000, 9999999)}\n'
+                                   'Nome/Razão Social: EMPRESA SINTETICA LTDA Nome Fantasia: SINTETICA Tel.: (21) 2222-3333\n'
+                                   'Endereço: RUA DO OUVIDOR 50 CEP: 20040-030 Município: Rio de Janeiro UF: RJ')],
+        [('TOMADOR DE SERVIÇOS', 'CPF/CNPJ: 11.222.333/0001-44 Inscrição Municipal: 1234567\n'
+                                 'Nome/Razão Social: CLIENTE SINTETICO SA Endereço: AV RIO BRANCO 1 CEP: 20090-003\n'
+                                 'Município: Rio de Janeiro UF: RJ E-mail: nfe@cliente.com.br')],
+        [('VALOR DA NOTA = R$ ' + formatMoney(total), '')],
+        [('Deduções (R$)', '0,00'), ('Desconto Incond. (R$)', '0,00'), ('Base de Cálculo (R$)', formatMoney(total))],
+        [('Aliquota (%)', '5,00%'), ('Valor do ISS (R$)', formatMoney(iss)), ('Crédito p/ IPTU (R$)', '0,00')],
+    ]
+    truth = {
+        'invoice_num': values['invoice_num'],
+        'invoice_creation': values['invoice_creation'],
+        'invoice_verif_cod': values['invoice_verif_cod'],
+        'invoice_value_raw': formatMoney(total),
+        'invoice_calc_base_tax': formatMoney(total),
+        'invoice_iss_tax': formatMoney(iss),
+    }
+    return 'PREFEITURA DA CIDADE DO RIO DE JANEIRO', cells, truth
+
+
+def drawInvoice(title, rows, path):
+    page = Image.new('L', PAGE_SIZE, 255)
+    draw = ImageDraw.Draw(page)
+    title_font = loadFont(44)
+    label_font = loadFont(30)
+    value_font = loadFont(28)
+
+    draw.text((MARGIN, MARGIN), title, font=title_font, fill=0)
+    top = MARGIN + 100
+    width = PAGE_SIZE[0] - 2 * MARGIN
+    for row in rows:
+        lines = max(1 + (value.count('\n') + 1 if value else 0) for label, value in row)
+        height = max(CELL_HEIGHT, 50 + 40 * lines)
+        cell_width = width // len(row)
+        for idx, (label, value) in enumerate(row):
+            left = MARGIN + idx * cell_width
+            draw.rectangle((left, top, left + cell_width, top + height), outline=0, width=3)
+            draw.text((left + 20, top + 20), label, font=label_font, fill=0)
+            if value:
+                draw.multiline_text((left + 20, top + 65), value, font=value_font, fill=0, spacing=10)
+        top += height
+
+    page.save(path, 'PDF', resolution=PAGE_DPI)
+
+
+def generateFixtures(dest, count, seed):
+    rng = random.Random(seed)
+    os.makedirs(dest, exist_ok=True)
+    truth = {}
+    for idx in range(count):
+        city = 'SP' if idx % 2 == 0 else 'RJ'
+        title, rows, fields = spLayout(rng) if city == 'SP' else rjLayout(rng)
+        name = fr'{city}_bench_{idx:04d}'
+        drawInvoice(title, rows, os.path.join(dest, fr'{name}.pdf'))
+        truth[name] = fields
+    with open(os.path.join(dest, 'ground_truth.json'), 'w') as truth_file:
+        json.dump(truth, truth_file, indent=2, sort_keys=True)
+    return truth
+
+
+def percentile(values, share):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+
+def runConfig(fixtures, workers):
+    # Runs inside the child interpreter started by main, with NFE_OCR_DPI already set
+    from nfe_ocr import OCR_TIERED, RENDER_DPI, ROI_PREPROCESS, extractMany
+
+    with open(os.path.join(fixtures, 'ground_truth.json'), 'r') as truth_file:
+        truth = json.load(truth_file)
+    paths = [os.path.join(fixtures, fr'{name}.pdf') for name in sorted(truth)]
+
+    latencies = []
+    stages = {}
+    errors = 0
+    fields_total = 0
+    fields_ok = 0
+    start = time.perf_counter()
+    for result in extractMany(paths, workers=workers):
+        expected = truth.get(result['name'], {})
+        fields_total += len(expected)
+        if 'error' in result:
+            errors += 1
+            continue
+        latencies.append(sum(seconds for stage, seconds in result['timings']))
+        for stage, seconds in result['timings']:
+            stages.setdefault(stage, []).append(seconds)
+        invoice_info = result['invoice_info'] or {}
+        for key, value in expected.items():
+            if (invoice_info.get(key) or {}).get('value') == value:
+                fields_ok += 1
+    wall = time.perf_counter() - start
+
+    peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        'dpi': RENDER_DPI,
+        'workers': workers,
+        'preprocess': 'tiered' if OCR_TIERED else ROI_PREPROCESS,
+        'documents': len(paths),
+        'errors': errors,
+        'wall_seconds': round(wall, 4),
+        'docs_per_sec': round(len(paths) / wall, 4) if wall > 0 else None,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p95': percentile(latencies, 0.95),
+        'peak_rss_mb': round(peak_rss_kb / 1024, 1),
+        'field_accuracy': round(fields_ok / fields_total, 4) if fields_total > 0 else None,
+        'stages': {
+            stage: {'mean': sum(values) / len(values), 'p95': percentile(values, 0.95)}
+            for stage, values in sorted(stages.items())
+        },
+    }
+
+
+def compareBaseline(results, baseline, max_regression):
+    regressions = []
+    previous = {(run['dpi'], run['workers'], run.get('preprocess', 'fixed')): run for run in baseline.get('runs', [])}
+    for run in results['runs']:
+        before = previous.get((run['dpi'], run['workers'], run['preprocess']))
+        if before is None:
+            continue
+        for metric, higher_is_better in (('docs_per_sec', True), ('latency_p95', False), ('field_accuracy', True)):
+            old, new = before.get(metric), run.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            print(fr'    dpi {run["dpi"]} workers {run["workers"]} {run["preprocess"]} {metric:<15} {old:10.4f} -> {new:10.4f} ({100 * change:+.1f}%)')
+            if (higher_is_better and change < -max_regression) or (not higher_is_better and change > max_regression):
+                regressions.append((run['dpi'], run['workers'], metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the NFS-e pipeline on synthetic RJ/SP invoices')
+    parser.add_argument('--count', type=int, default=20, help='Number of synthetic invoices, half SP and half RJ')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the synthetic invoices')
+    parser.add_argument('--dpis', default='500', help='Comma separated render DPIs')
+    parser.add_argument('--workers', default='1', help='Comma separated worker counts')
+    parser.add_argument('--preprocess', default='tiered', help='Comma separated OCR modes: tiered, or fixed/adaptive for a single pass with that ROI preprocessing')
+    parser.add_argument('--fixtures', default=None, help='Folder for the fixtures, a temporary one by default')
+    parser.add_argument('--output', default='bench_results.json', help='Machine readable results')
+    parser.add_argument('--baseline', default=None, help='Earlier results to compare with')
+    parser.add_argument('--max-regression', type=float, default=0.10, help='Allowed relative regression against the baseline')
+    parser.add_argument('--run-config', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_config is not None:
+        print('BENCH_RESULT ' + json.dumps(runConfig(args.fixtures, args.run_config)))
+        return
+
+    for preprocess in args.preprocess.split(','):
+        if preprocess not in PREPROCESS_MODES:
+            parser.error(fr'Unknown preprocess mode {preprocess}')
+
+    fixtures = args.fixtures or tempfile.mkdtemp(prefix='nfe_bench_')
+    generateFixtures(fixtures, args.count, args.seed)
+
+    results = {'count': args.count, 'seed': args.seed, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'runs': []}
+    configs = [
+        (int(dpi), int(workers), preprocess)
+        for dpi in args.dpis.split(',') for workers in args.workers.split(',') for preprocess in args.preprocess.split(',')
+    ]
+    for dpi, workers, preprocess in configs:
+        env = dict(os.environ, NFE_OCR_DPI=str(dpi), NFE_OCR_LAYOUT_CACHE='0', NFE_OCR_METRICS_LOG='', **PREPROCESS_MODES[preprocess])
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--fixtures', fixtures, '--run-config', str(workers)],
+            stdout=subprocess.PIPE,
+            env=env,
+            check=True
+        )
+        lines = completed.stdout.decode('utf-8').splitlines()
+        run = json.loads(next(line for line in reversed(lines) if line.startswith('BENCH_RESULT '))[len('BENCH_RESULT '):])
+        results['runs'].append(run)
+        ocr_mean = sum(run['stages'].get(stage, {}).get('mean') or 0.0 for stage in ('extract_txt', 'escalate_ocr'))
+        print(fr'dpi {dpi:4d} workers {workers:2d} {preprocess:<8}  {run["docs_per_sec"]:7.3f} docs/s  p50 {run["latency_p50"]:.3f}s  '
+              fr'p95 {run["latency_p95"]:.3f}s  ocr {ocr_mean:.3f}s  rss {run["peak_rss_mb"]:.0f} MB  accuracy {run["field_accuracy"]}')
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        print(fr'Comparison with {args.baseline}')
+        regressions = compareBaseline(results, baseline, args.max_regression)
+        if regressions:
+            print(fr'{len(regressions)} regressions above {100 * args.max_regression:.0f}%')
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
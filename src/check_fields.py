@@ -0,0 +1,71 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+from invoice_fields import extractInvoiceFields
+
+# Golden set check for the field extraction: every file holds the raw Tesseract text of the
+# regions of one invoice ('roi_text') next to the 'invoice_info' and 'raw' results that were
+# accepted for it. Result cache entries written with NFE_OCR_CACHE_ROI_TEXT=1 have exactly
+# this format, so a cache folder filled by a known good version is a ready golden set.
+#
+#   python3 src/check_fields.py ./cache
+
+
+def loadGoldenSet(paths):
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(os.path.join(path, '*.json'))) if os.path.isdir(path) else [path]
+    for file in files:
+        try:
+            with open(file, 'r') as golden_file:
+                entry = json.load(golden_file)
+        except (OSError, ValueError):
+            continue
+        if isinstance(entry, dict) and 'roi_text' in entry and 'invoice_info' in entry:
+            yield file, entry
+
+
+def withoutConfidences(field):
+    # Entries of a cache filled with OCR word data carry a confidence on every field, which
+    # the text alone cannot reproduce
+    if not isinstance(field, dict):
+        return field
+    return {key: withoutConfidences(value) for key, value in field.items() if key != 'confidence'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare extractInvoiceFields against a golden set of invoices')
+    parser.add_argument('paths', nargs='+', help='Golden JSON files or folders containing them')
+    args = parser.parse_args()
+
+    checked = 0
+    failures = 0
+    elapsed = 0.0
+    for file, entry in loadGoldenSet(args.paths):
+        expected = withoutConfidences(entry['invoice_info'])
+        invoice_city = expected.get('invoice_city', {}).get('value')
+        if invoice_city not in ('RJ', 'SP'):
+            continue
+
+        start = time.perf_counter()
+        invoice_raw_info, invoice_info = extractInvoiceFields(entry['roi_text'], invoice_city)
+        elapsed += time.perf_counter() - start
+        checked += 1
+
+        if invoice_info != expected or invoice_raw_info != entry.get('raw', invoice_raw_info):
+            failures += 1
+            print(fr'FAIL {file}')
+            for key in sorted(set(invoice_info) | set(expected)):
+                if invoice_info.get(key) != expected.get(key):
+                    print(fr'    {key}: expected {expected.get(key)} got {invoice_info.get(key)}')
+
+    print(fr'{checked} invoices checked, {failures} different, {elapsed:.3f}s in extractInvoiceFields')
+    sys.exit(1 if failures > 0 or checked == 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
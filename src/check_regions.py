@@ -0,0 +1,129 @@
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+from pdf2image import convert_from_path
+
+from nfe_ocr import RENDER_DPI, findTableContours, tableBox
+
+# Regression harness for the table detection of markRegion: compares the ROI boxes found by
+# findTableContours against the original implementation, kept verbatim below.
+#
+#   python3 src/check_regions.py ./input/SP_invoice.pdf ./input/RJ_invoice.pdf
+#   python3 src/check_regions.py ./input/*.pdf --scale 0.5 --tolerance 1
+#   python3 src/check_regions.py ./input/*.pdf --render-dpi 150 --tolerance 3
+#
+# --render-dpi checks the text layer path instead: the page is rasterized again at that DPI
+# (page images are reduced to it) and the boxes are detected on it as extractTextLayer does.
+
+
+def referenceContours(img):
+    alpha = 0.5
+    beta = 1.0 - alpha
+
+    (thresh, img_bin) = cv2.threshold(img, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    img_bin = 255 - img_bin
+
+    verticle_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 9))
+    hori_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 1))
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+    img_temp1 = cv2.erode(img_bin, verticle_kernel, iterations=13)
+    verticle_lines_img = cv2.dilate(img_temp1, verticle_kernel, iterations=9, borderValue=10)
+
+    img_temp2 = cv2.erode(img_bin, hori_kernel, iterations=13)
+    horizontal_lines_img = cv2.dilate(img_temp2, hori_kernel, iterations=3)
+
+    img_final_bin = cv2.addWeighted(verticle_lines_img, alpha, horizontal_lines_img, beta, 0.0)
+    img_final_bin = cv2.erode(~img_final_bin, kernel, iterations=3)
+    (thresh, img_final_bin) = cv2.threshold(img_final_bin, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+
+    img_final_bin = cv2.dilate(
+        ~img_final_bin,
+        cv2.getStructuringElement(cv2.MORPH_ERODE, (5, 5)),
+        iterations=11
+    )
+
+    img_final_bin = cv2.GaussianBlur(~img_final_bin, (5, 5), 5)
+
+    img_final_bin = cv2.erode(
+        ~img_final_bin,
+        cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)),
+        iterations=2
+    )
+
+    contours, hierarchy = cv2.findContours(img_final_bin, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+    return contours
+
+
+def loadPage(path, dpi, image_dpi=None):
+    # image_dpi: resolution of a page image, reduced to dpi when given
+    if path.lower().endswith('.pdf'):
+        pages = convert_from_path(path, dpi, first_page=1, last_page=1, grayscale=True)
+        return np.array(pages[0].convert('L'))
+    img = cv2.imread(path, 0)
+    if img is not None and image_dpi is not None and image_dpi != dpi:
+        img = cv2.resize(img, None, fx=dpi / image_dpi, fy=dpi / image_dpi, interpolation=cv2.INTER_AREA)
+    return img
+
+
+def roiBoxes(contours):
+    boxes = [tableBox(c) for c in contours]
+    return sorted(box for box in boxes if box is not None)
+
+
+def matchBoxes(expected, found, tolerance):
+    unmatched = list(found)
+    missing = []
+    for box in expected:
+        match = next((other for other in unmatched if max(abs(a - b) for a, b in zip(box, other)) <= tolerance), None)
+        if match is None:
+            missing.append(box)
+        else:
+            unmatched.remove(match)
+    return missing, unmatched
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that findTableContours finds the same ROI boxes as the original markRegion')
+    parser.add_argument('paths', nargs='+', help='Invoice PDFs or page images')
+    parser.add_argument('--dpi', type=int, default=RENDER_DPI, help='Resolution used to rasterize PDFs')
+    parser.add_argument('--scale', type=float, default=1.0, help='Detection scale passed to findTableContours')
+    parser.add_argument('--render-dpi', type=int, default=0, help='Detect on a page rendered at this resolution, as the text layer does')
+    parser.add_argument('--tolerance', type=int, default=0, help='Maximum difference in pixels of any box coordinate')
+    args = parser.parse_args()
+
+    failures = 0
+    for path in args.paths:
+        img = loadPage(path, args.dpi)
+        if img is None:
+            print(fr'SKIP {path} - could not be read')
+            continue
+
+        start = time.perf_counter()
+        expected = roiBoxes(referenceContours(img))
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if args.render_dpi > 0:
+            found = roiBoxes(findTableContours(loadPage(path, args.render_dpi, args.dpi), args.render_dpi / args.dpi, prescaled=True))
+        else:
+            found = roiBoxes(findTableContours(img, args.scale))
+        optimized_time = time.perf_counter() - start
+
+        missing, extra = matchBoxes(expected, found, args.tolerance)
+        status = 'OK  ' if len(missing) == 0 and len(extra) == 0 else 'FAIL'
+        failures += status == 'FAIL'
+        print(fr'{status} {path} - {len(expected)} boxes - reference {reference_time:.3f}s - optimized {optimized_time:.3f}s')
+        for box in missing:
+            print(fr'    missing {box}')
+        for box in extra:
+            print(fr'    extra   {box}')
+
+    sys.exit(1 if failures > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import bisect
+import hashlib
+import json
+import os
+import time
+import uuid
+
+
+def ringHash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class ClusterCoordinator:
+    # Lets several containers share one INPUT folder. Every node keeps a heartbeat file in
+    # path/nodes; the live ones (heartbeat younger than the lease) form a consistent hash ring
+    # and each PDF name belongs to one of them, so nodes joining or leaving only move the names
+    # next to them. Before processing, the owner takes the claim path/<name>.claim, created
+    # with O_EXCL so only one node can hold it, and renews it while the job runs. A running
+    # claim not renewed for lease_seconds belongs to a dead node and is taken over; finished
+    # claims keep other nodes from redoing the job until the PDF is replaced.
+    # Leases compare file mtimes with the local clock, so the nodes need synchronized clocks.
+
+    def __init__(self, path, node_id, lease_seconds, vnodes=64):
+        self.path = path
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        self.vnodes = vnodes
+        self.nodes_path = os.path.join(path, 'nodes')
+        self.members = ()
+        self.ring = []
+        self.ring_nodes = []
+        os.makedirs(self.nodes_path, exist_ok=True)
+
+    def heartbeat(self):
+        # Renews this node's heartbeat and rebuilds the ring; True when the members changed
+        beat_path = os.path.join(self.nodes_path, self.node_id)
+        with open(beat_path, 'a'):
+            pass
+        os.utime(beat_path)
+
+        now = time.time()
+        members = []
+        for node in os.listdir(self.nodes_path):
+            try:
+                age = now - os.path.getmtime(os.path.join(self.nodes_path, node))
+            except OSError:
+                continue
+            if node == self.node_id or age <= self.lease_seconds:
+                members.append(node)
+        members = tuple(sorted(members))
+        if members == self.members:
+            return False
+
+        points = sorted((ringHash(fr'{node}#{idx}'), node) for node in members for idx in range(self.vnodes))
+        self.ring = [point for point, node in points]
+        self.ring_nodes = [node for point, node in points]
+        self.members = members
+        print(fr'Cluster members: {", ".join(members)}')
+        return True
+
+    def ownerOf(self, name):
+        idx = bisect.bisect(self.ring, ringHash(name)) % len(self.ring)
+        return self.ring_nodes[idx]
+
+    def isOwner(self, name):
+        return len(self.ring) == 0 or self.ownerOf(name) == self.node_id
+
+    def claimPath(self, name):
+        return os.path.join(self.path, fr'{name}.claim')
+
+    def readClaim(self, claim_path):
+        try:
+            with open(claim_path, 'r') as claim_file:
+                claim = json.load(claim_file)
+            claim['mtime'] = os.path.getmtime(claim_path)
+            return claim
+        except (OSError, ValueError):
+            return None
+
+    def writeClaim(self, claim_path, fingerprint, state, exclusive):
+        body = json.dumps({'node': self.node_id, 'fingerprint': fingerprint, 'state': state, 'time': time.time()})
+        if exclusive:
+            try:
+                fd = os.open(claim_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                return False
+            with os.fdopen(fd, 'w') as claim_file:
+                claim_file.write(body)
+            return True
+        tmp_path = fr'{claim_path}.{self.node_id}.tmp'
+        with open(tmp_path, 'w') as claim_file:
+            claim_file.write(body)
+        os.replace(tmp_path, claim_path)
+        return True
+
+    def claimInfo(self, name):
+        # {'node', 'fingerprint', 'state', 'time', 'mtime'} of the claim, None when there is none
+        return self.readClaim(self.claimPath(name))
+
+    def claim(self, name, fingerprint, result_exists):
+        # True when this node may process the PDF now
+        claim_path = self.claimPath(name)
+        if self.writeClaim(claim_path, fingerprint, 'running', exclusive=True):
+            return True
+
+        claim = self.readClaim(claim_path)
+        if claim is None:
+            return False
+        if claim['state'] == 'running':
+            if claim['node'] == self.node_id:
+                return True
+            takeover = time.time() - claim['mtime'] > self.lease_seconds
+        else:
+            # Finished: only a replaced PDF, or a result removed to ask for a new run, reopens it
+            takeover = claim['fingerprint'] != fingerprint or (claim['state'] == 'done' and not result_exists)
+        if not takeover:
+            return False
+
+        # Moving the claim aside is atomic, so only one of the nodes taking it over gets it; a
+        # node that moved a claim renewed in the meantime puts it back
+        stale_path = fr'{claim_path}.{uuid.uuid4().hex}.stale'
+        try:
+            os.rename(claim_path, stale_path)
+        except OSError:
+            return False
+        moved = self.readClaim(stale_path)
+        if moved is None or moved['node'] != claim['node'] or moved['time'] != claim['time'] or moved['mtime'] != claim['mtime']:
+            try:
+                os.link(stale_path, claim_path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        if claim['state'] == 'running':
+            print(fr'Claim of {claim["node"]} expired, taking over - File {name}')
+        return self.writeClaim(claim_path, fingerprint, 'running', exclusive=True)
+
+    def renew(self, names):
+        # Extends the lease of the running jobs; returns the ones another node took over
+        lost = []
+        for name in names:
+            claim_path = self.claimPath(name)
+            claim = self.readClaim(claim_path)
+            if claim is None or claim['node'] != self.node_id:
+                lost.append(name)
+                continue
+            try:
+                os.utime(claim_path)
+            except OSError:
+                lost.append(name)
+        return lost
+
+    def finish(self, name, fingerprint, state):
+        claim = self.readClaim(self.claimPath(name))
+        if claim is not None and claim['node'] == self.node_id:
+            self.writeClaim(self.claimPath(name), fingerprint, state, exclusive=False)
@@ -0,0 +1,287 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+from metrics import enableForwarding, flushForwarded, inc, startMetricsServer
+from nfe_ocr import FILE_TIMEOUT, METRICS_PORT, QUEUE_SIZE, ROI_FILTER, WORKERS, extractOne, invoiceCity
+from ocr_engine import OCR_THREADS, preloadEngines
+
+# HTTP entry point of the pipeline, next to the INPUT folder loop of nfe_ocr.py:
+#
+#   python3 src/ingest_server.py
+#
+#   POST /invoices?name=SP_123&wait=1   body: the PDF  -> 200 with the invoices once extracted
+#   POST /invoices?city=RJ              body: the PDF  -> 202 with the job id
+#   GET  /invoices/<job id>                            -> 200 with the job status and invoices
+#
+# Uploads wait in a bounded queue for the worker processes; when it is full the upload is
+# refused with 429 and Retry-After instead of piling up in memory.
+
+HTTP_PORT = int(os.environ.get('NFE_OCR_HTTP_PORT', 8080))
+MAX_UPLOAD_MB = int(os.environ.get('NFE_OCR_MAX_UPLOAD_MB', 20))
+JOB_TTL = int(os.environ.get('NFE_OCR_JOB_TTL', 3600))
+
+REASONS = {
+    200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    411: 'Length Required', 413: 'Payload Too Large', 429: 'Too Many Requests', 500: 'Internal Server Error',
+}
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def jobView(job):
+    view = {key: job[key] for key in ('id', 'status', 'name', 'city', 'created', 'finished', 'error')}
+    if job['invoices'] is not None:
+        view['invoices'] = [
+            {key: invoice.get(key) for key in ('name', 'page', 'invoice_city', 'invoice_info', 'text_source', 'error')}
+            for invoice in job['invoices']
+        ]
+    return view
+
+
+def runJob(send_conn, item):
+    try:
+        send_conn.send(('ok', extractOne(item)))
+    except Exception as err:
+        send_conn.send(('error', str(err)))
+    flushForwarded()
+    send_conn.close()
+
+
+def waitJob(proc, recv_conn, timeout):
+    # Blocks one thread of the service until the job process answers, dies or runs out of time;
+    # a process still running then is killed, so a hung PDF never keeps its worker slot
+    answered = False
+    try:
+        if recv_conn.poll(timeout):
+            outcome = recv_conn.recv()
+            answered = True
+            return outcome
+        return 'timeout', None
+    except (EOFError, OSError):
+        proc.join(5)
+        return 'crashed', proc.exitcode
+    finally:
+        recv_conn.close()
+        if answered:
+            # Lets it send its metrics and exit
+            proc.join(5)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join(5)
+            if proc.is_alive():
+                proc.kill()
+        proc.join()
+
+
+class IngestService:
+    # Jobs live in memory: the queue holds the ones waiting for a worker and finished ones are
+    # kept JOB_TTL seconds for polling. Each of the worker tasks runs one PDF at a time in a
+    # child process of its own, as the scheduler of nfe_ocr.py does, so at most `workers` PDFs
+    # are extracted at once and a PDF that crashes or hangs only takes down its own process.
+
+    def __init__(self, workers, max_queued, timeout):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.jobs = {}
+        self.waiters = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ingest-wait')
+
+    def start(self):
+        return [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+    def submit(self, pdf_bytes, name, city):
+        self.expire()
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id, 'status': 'queued', 'name': name, 'city': city, 'created': time.time(),
+            'finished': None, 'error': None, 'invoices': None, 'done': asyncio.Event(),
+        }
+        try:
+            self.queue.put_nowait((job, pdf_bytes))
+        except asyncio.QueueFull:
+            inc('nfe_http_rejected_total')
+            raise HttpError(429, 'The queue is full, try again later')
+        self.jobs[job_id] = job
+        return job
+
+    async def work(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            job, pdf_bytes = await self.queue.get()
+            job['status'] = 'running'
+            try:
+                recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+                proc = multiprocessing.Process(target=runJob, args=(send_conn, (pdf_bytes, job['name'], job['city'])),
+                                               name=fr'nfe-http-{job["id"]}', daemon=True)
+                proc.start()
+                # Only the child keeps the sending end, so its death shows up here as EOF
+                send_conn.close()
+                outcome, value = await loop.run_in_executor(self.waiters, waitJob, proc, recv_conn, self.timeout)
+                if outcome == 'ok':
+                    job['invoices'] = value
+                    failed = [invoice['error'] for invoice in job['invoices'] if 'error' in invoice]
+                    job['status'] = 'failed' if failed else 'done'
+                    job['error'] = failed[0] if failed else None
+                elif outcome == 'timeout':
+                    job['status'] = 'failed'
+                    job['error'] = fr'timed out after {self.timeout}s'
+                elif outcome == 'crashed':
+                    # poppler/tesseract crash or OOM kill
+                    job['status'] = 'failed'
+                    job['error'] = fr'worker crashed - exit code {value}'
+                else:
+                    job['status'] = 'failed'
+                    job['error'] = value
+            except Exception as err:
+                job['status'] = 'failed'
+                job['error'] = str(err)
+            job['finished'] = time.time()
+            job['done'].set()
+            inc('nfe_http_jobs_total', {'status': job['status']})
+            print(fr'Job {job["id"]} {job["status"]} - File {job["name"]}')
+            self.queue.task_done()
+
+    def expire(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job['finished'] is not None and now - job['finished'] > JOB_TTL:
+                del self.jobs[job_id]
+
+
+async def readRequest(reader):
+    request_line = (await reader.readline()).decode('latin-1').strip()
+    if not request_line:
+        return None
+    try:
+        method, target, version = request_line.split(' ', 2)
+    except ValueError:
+        raise HttpError(400, 'Malformed request line')
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1')
+        if line in ('\r\n', '\n', ''):
+            break
+        key, _, value = line.partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+    body = b''
+    if method == 'POST':
+        if 'content-length' not in headers:
+            raise HttpError(411, 'Content-Length is required')
+        length = int(headers['content-length'])
+        if length > MAX_UPLOAD_MB * 1024 * 1024:
+            raise HttpError(413, fr'Uploads are limited to {MAX_UPLOAD_MB} MB')
+        body = await reader.readexactly(length)
+    return method, target, headers, body
+
+
+async def writeResponse(writer, status, payload, extra_headers=None):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    head = [fr'HTTP/1.1 {status} {REASONS.get(status, "")}', 'Content-Type: application/json; charset=utf-8',
+            fr'Content-Length: {len(body)}', 'Connection: close']
+    for key, value in (extra_headers or {}).items():
+        head.append(fr'{key}: {value}')
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+    inc('nfe_http_requests_total', {'status': str(status)})
+
+
+async def handlePost(service, query, body):
+    if not body.startswith(b'%PDF'):
+        raise HttpError(400, 'The body must be the PDF file')
+    name = query.get('name', [None])[0] or fr'upload_{int(time.time() * 1000)}'
+    if os.path.basename(name) != name:
+        raise HttpError(400, 'Invalid name')
+    city = (query.get('city', [None])[0] or invoiceCity(name) or '').upper()
+    if city not in ('SP', 'RJ'):
+        raise HttpError(400, 'Unknown city, pass city=SP or city=RJ or a name starting with SP_/RJ_')
+
+    wait = query.get('wait', ['0'])[0]
+    timeout = None
+    if wait not in ('', '0'):
+        # Synchronous mode: answer with the invoices, or with the job id if it takes too long
+        try:
+            timeout = service.timeout if wait == '1' else min(float(wait), service.timeout)
+        except ValueError:
+            raise HttpError(400, 'wait must be a number of seconds')
+
+    job = service.submit(body, name, city)
+    if timeout is not None:
+        try:
+            await asyncio.wait_for(job['done'].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        if job['finished'] is not None:
+            return 200, jobView(job), None
+    return 202, jobView(job), {'Location': fr'/invoices/{job["id"]}'}
+
+
+async def handleConnection(service, reader, writer):
+    try:
+        try:
+            request = await readRequest(reader)
+            if request is None:
+                return
+            method, target, headers, body = request
+            url = urlsplit(target)
+            query = parse_qs(url.query, keep_blank_values=True)
+            parts = [part for part in url.path.split('/') if part]
+
+            if parts == ['invoices'] and method == 'POST':
+                status, payload, extra_headers = await handlePost(service, query, body)
+            elif len(parts) == 2 and parts[0] == 'invoices' and method == 'GET':
+                job = service.jobs.get(parts[1])
+                if job is None:
+                    raise HttpError(404, 'Unknown job')
+                status, payload, extra_headers = 200, jobView(job), None
+            elif parts == ['health'] and method == 'GET':
+                status, payload, extra_headers = 200, {'queued': service.queue.qsize(), 'jobs': len(service.jobs)}, None
+            elif parts[:1] == ['invoices'] or parts == ['health']:
+                raise HttpError(405, 'Method not allowed')
+            else:
+                raise HttpError(404, 'Not found')
+        except HttpError as err:
+            status, payload = err.status, {'error': str(err)}
+            extra_headers = {'Retry-After': '5'} if err.status == 429 else None
+        except (asyncio.IncompleteReadError, ValueError) as err:
+            status, payload, extra_headers = 400, {'error': str(err)}, None
+        await writeResponse(writer, status, payload, extra_headers)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(port):
+    service = IngestService(WORKERS, QUEUE_SIZE, FILE_TIMEOUT)
+    workers = service.start()
+    server = await asyncio.start_server(lambda reader, writer: handleConnection(service, reader, writer), '0.0.0.0', port)
+    dt_string = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    print(fr'Listening for invoices on port {port} - {dt_string}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        service.waiters.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    if METRICS_PORT > 0:
+        enableForwarding()
+        startMetricsServer(METRICS_PORT)
+    preloadEngines(OCR_THREADS, ('full', 'header') if ROI_FILTER else ('full',))
+    asyncio.run(serve(HTTP_PORT))
@@ -0,0 +1,132 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def openInotify(path):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+        if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+class InputWatcher:
+    # Reports every PDF of the INPUT folder once it is fully written and keeps the set of
+    # invoices that already have a .json result, so the folder is not re-listed every cycle.
+    # Uses inotify when available (close-after-write/rename means the copy finished); without
+    # it, or on volumes that do not deliver events, a periodic listdir finds new PDFs and a PDF
+    # is only reported after its size and mtime stop changing.
+
+    def __init__(self, path, poll_interval, rescan_interval):
+        self.path = path
+        self.fd = openInotify(path)
+        self.scan_interval = rescan_interval if self.fd is not None else poll_interval
+        self.done = set()
+        self.known = set()
+        self.growing = {}
+        self.last_scan = None
+        self.last_check = 0
+
+    def mode(self):
+        return 'inotify' if self.fd is not None else 'polling'
+
+    def poll(self, timeout):
+        ready = []
+        if self.fd is not None:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if readable:
+                ready += self.readEvents()
+        else:
+            time.sleep(timeout)
+
+        now = time.monotonic()
+        if self.last_scan is None or now - self.last_scan >= self.scan_interval:
+            ready += self.scan()
+            self.last_scan = now
+        elif self.growing and now - self.last_check >= 1:
+            ready += self.checkGrowing()
+            self.last_check = now
+        return ready
+
+    def readEvents(self):
+        ready = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                file = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                ready += self.handleEvent(file, mask)
+        return ready
+
+    def handleEvent(self, file, mask):
+        name, ext = os.path.splitext(file)
+        created = mask & (IN_CLOSE_WRITE | IN_MOVED_TO)
+        if ext == '.pdf':
+            if created:
+                self.growing.pop(name, None)
+                self.known.add(name)
+                return [name]
+            self.known.discard(name)
+            self.growing.pop(name, None)
+        elif ext == '.json':
+            if created:
+                self.done.add(name)
+            else:
+                # The result was removed, the invoice has to be processed again
+                self.done.discard(name)
+                if name in self.known:
+                    return [name]
+        return []
+
+    def scan(self):
+        files = os.listdir(self.path)
+        self.done = set(os.path.splitext(file)[0] for file in files if file.endswith('.json'))
+        pdfs = set(os.path.splitext(file)[0] for file in files if file.endswith('.pdf'))
+        self.known &= pdfs
+        for name in pdfs - self.known:
+            if name not in self.growing:
+                self.growing[name] = None
+        return self.checkGrowing()
+
+    def checkGrowing(self):
+        ready = []
+        for name, previous in list(self.growing.items()):
+            try:
+                stat = os.stat(os.path.join(self.path, fr'{name}.pdf'))
+            except OSError:
+                del self.growing[name]
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            if signature == previous:
+                del self.growing[name]
+                self.known.add(name)
+                ready.append(name)
+            else:
+                self.growing[name] = signature
+        return ready
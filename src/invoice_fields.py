@@ -0,0 +1,311 @@
+import re
+from collections import Counter
+
+from fuzzywuzzy import fuzz
+
+# Declarative description of the fields read from each municipality's NFS-e. A spec is the
+# list of label variants that identify the OCR chunk (compared lowercase, partial_ratio > 90
+# like the normalizers always did) and the function that turns the chunk into invoice_info
+# entries. Everything below is compiled once at import.
+
+MONEY = r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}'
+DOC_NUMBER = r'(?<=CPF\/CNPJ:\s)(([0-9]{3}\.?[0-9]{3}\.?[0-9]{3}\-?[0-9]{2}|[0-9]{2}\.?[0-9]{3}\.?[0-9]{3}\/?[0-9]{4}\s?\-?\s?[0-9]{2}))(?=\s)'
+ZIP_CODE = r'(?<=CEP:\s)(\d{5}-\d{3})'
+STATE = r'(?<=UF:\s)(.*?)(?=\s)'
+EMAIL = r'(?<=E-mail:\s)(.*?)(?=\s)'
+
+ORDER_NUMBER_PATTERNS = [
+    re.compile(fr'(?<={op}:\s)(.*?)(?=\s)') for op in [
+        r'[N|n][º] [D|d][O|o] [P|p][E|e][D|d][I|i][D|d][O|o]',
+        r'[O|o][R|r][D|d][E|e][M|m] [D|d][E|e] [C|c][O|o][M|m][P|p][R|r][A|a]',
+        r'[P|p][E|e][D|d][I|i][D|d][O|o] [D|d][E|e] [C|c][O|o][M|m][P|p][R|r][A|a]',
+        r'[P|p][E|e][D|d][I|i][D|d][O|o] [D|d][O|o] [P|p][E|e][D|d][I|i][D|d][O|o]',
+        r'[P|p][E|e][D|d][I|i][D|d][O|o] [O|o][C|c]',
+        r'[P|p][E|e][D|d][I|i][D|d][O|o]',
+    ]
+]
+NET_VALUE_LABEL = re.compile(r'(?<=[V|v][A|a][L|l][O|o][R|r] [L|l][I|i][Q|q][U|u][I|Í|i|í][D|d][O|o]).*')
+NET_VALUE = re.compile(MONEY + r'(?=\s)')
+
+
+def searchValue(key, pattern):
+    regex = re.compile(pattern)
+
+    def extract(aux):
+        key_value = regex.search(aux)
+        return {key: {
+            'value': key_value.group() if key_value is not None else None,
+            'raw': aux
+        }}
+    return extract
+
+
+def partyValues(key, fields):
+    # fields: (name, pattern, group), group 1 for the patterns that used re.findall(...)[0]
+    compiled = [(name, re.compile(pattern), group) for name, pattern, group in fields]
+
+    def extract(aux):
+        party = {}
+        for name, regex, group in compiled:
+            key_value = regex.search(aux)
+            party[name] = {'value': key_value.group(group) if key_value is not None else None}
+        party['raw'] = aux
+        return {key: party}
+    return extract
+
+
+def descriptionValues(aux):
+    order_number = None
+    for regex in ORDER_NUMBER_PATTERNS:
+        key_value = regex.search(aux)
+        if key_value is not None:
+            order_number = key_value.group()
+            break
+
+    key_value_aux = NET_VALUE_LABEL.search(aux)
+    key_value_aux = key_value_aux.group() if key_value_aux is not None else ''
+    key_value = NET_VALUE.search(key_value_aux)
+
+    return {
+        'invoice_description': {
+            'order_number': order_number,
+            'raw': aux
+        },
+        'invoice_value_liq': {
+            'value': key_value.group() if key_value is not None else None,
+        }
+    }
+
+
+COMMON_HEADER_SPECS = [
+    (['numero da nota'], searchValue('invoice_num', r'\d+')),
+    (['data e hora de emissão', 'data e hora de emissao'],
+     searchValue('invoice_creation', r'(\d{2})\/(\d{2})\/(\d{4})\s(\d{2}):(\d{2}):(\d{2})')),
+    (['código de verificação', 'codigo de verificacao'],
+     searchValue('invoice_verif_cod', r'(?<=\s)([\w\|\d]+)-([\w\|\d]+)')),
+]
+
+RJ_FIELD_SPECS = COMMON_HEADER_SPECS + [
+    (['prestador de serviços', 'prestador de servicos'], partyValues('invoice_provider', [
+        ('doc_number', DOC_NUMBER, 0),
+        ('city_number', r'(?<=Inscrição Municipal:\s)(.*?)(?=\s)', 0),
+        ('state_number', r'(?<=Inscrição Estadual:\s)(.*?)(?=\s)', 0),
+        ('main_name', r'(?<=Nome\/Raz[a\|ã]o Social:\s)(.*?)(?=\sNome Fantasia)', 0),
+        ('sec_name', r'(?<=Nome Fantasia:\s)(.*?)(?=\sTel)', 0),
+        ('phone', r'(?<=Tel\.:\s)(\(?)(\d{2})(\)?)(\s?)(-?)(\d{4})(\s|-?)(\d{4})(?=\s)()', 0),
+        ('address', r'(?<=Endereço:\s)(.*?)(?=\sCEP)', 0),
+        ('zip_code', ZIP_CODE, 0),
+        ('city', r'(?<=Município:\s)(.*?)(?=\sUF)', 0),
+        ('state', STATE, 0),
+        ('email', EMAIL, 0),
+    ])),
+    (['tomador de serviços', 'tomador de servicos'], partyValues('invoice_client', [
+        ('doc_number', DOC_NUMBER, 0),
+        ('city_number', r'(?<=\sMunicipal:\s)(.*?)(?=\s)', 0),
+        ('state_number', r'(?<=Inscriç[a|ã]o Estadual:\s)(.*?)(?=\s)', 0),
+        ('main_name', r'(?<=Nome\/Raz[a|ã]o Social:\s)(.*?)(?=\sEndere[c|ç]o:)', 0),
+        ('address', r'(?<=Endere[c|ç|g]o:\s)(.*?)(?=\sCEP)', 0),
+        ('zip_code', ZIP_CODE, 0),
+        ('city', r'(?<=Munic[í|i]pio:\s)(.*?)(?=\sUF)', 0),
+        ('state', STATE, 0),
+        ('email', EMAIL, 0),
+    ])),
+    (['discriminação dos serviços', 'discriminacao dos servicos'], descriptionValues),
+    (['valor da nota'], searchValue('invoice_value_raw', MONEY)),
+    (['serviço prestado', 'servico prestado'], searchValue('invoice_service', r'(?<=Prestado\s)(\d+\.\d+\.\d).*')),
+    (['deduções', 'deducoes'], searchValue('invoice_deduc', MONEY)),
+    (['desconto incond.'], searchValue('invoice_discount', MONEY)),
+    (['base de cálculo', 'base de calculo'], searchValue('invoice_calc_base_tax', MONEY)),
+    (['aliquota'], searchValue('invoice_aliq_tax', MONEY + r'(\s?%?)')),
+    (['valor de iss'], searchValue('invoice_iss_tax', MONEY)),
+    (['crédito p/ iptu', 'credito p/ iptu'], searchValue('invoice_iptu_credit', MONEY)),
+]
+
+SP_FIELD_SPECS = COMMON_HEADER_SPECS + [
+    (['prestador de serviços', 'prestador de servicos'], partyValues('invoice_provider', [
+        ('doc_number', DOC_NUMBER, 0),
+        ('city_number', r'(?<=Inscri[c|ç][a|ã]o Municipal:\s)(.*?)(?=\s)', 0),
+        ('main_name', r'(?:Nome\/[A-zÀ-ÿ]+?\sSocial.\s)(.*)(?=\sEndere[c|ç]o)', 1),
+        ('address', r'(?<=Endere[c|ç]o:\s)(.*?)(?=\sCEP)', 0),
+        ('zip_code', ZIP_CODE, 0),
+        ('city', r'(?<=Munic[i|í]pio:\s)(.*?)(?=\sUF)', 0),
+        ('state', STATE, 0),
+    ])),
+    (['tomador de serviços', 'tomador de servicos'], partyValues('invoice_client', [
+        ('main_name', r'(?:Nome\/[A-zÀ-ÿ]+?\sSocial.\s)(.*)(?=\sCPF\/CNPJ.)', 1),
+        ('doc_number', DOC_NUMBER, 0),
+        ('city_number', r'(?<=\sMunicipal:\s)(.*?)(?=\s)', 0),
+        ('address', r'(?<=Endere[c|ç|g]o:\s)(.*?)(?=\sCEP)', 0),
+        ('zip_code', ZIP_CODE, 0),
+        ('city', r'(?<=Munic[í|i]pio:\s)(.*?)(?=\sUF)', 0),
+        ('state', STATE, 0),
+        ('email', EMAIL, 0),
+    ])),
+    (['discriminação dos serviços', 'discriminacao dos servicos'], descriptionValues),
+    (['valor total do serviço', 'valor total do servico'], searchValue('invoice_value_raw', MONEY)),
+    (['inss'], searchValue('invoice_tax_inss', MONEY)),
+    (['irrf'], searchValue('invoice_tax_irrf', MONEY)),
+    (['csll'], searchValue('invoice_tax_csll', MONEY)),
+    (['cofins'], searchValue('invoice_tax_cofins', MONEY)),
+    (['pis/pasep'], searchValue('invoice_tax_pis-pasep', MONEY)),
+    (['código do serviço', 'código do servico'], searchValue('invoice_service', r'(?<=\s)(\d+).*')),
+    (['valor total das deduções', 'valor total das deducoes'], searchValue('invoice_tax_deductions', MONEY)),
+    (['base de cálculo', 'base de calculo'], searchValue('invoice_tax_calc_base', MONEY)),
+    (['aliquota'], searchValue('invoice_tax_aliq', MONEY + r'(\s?%?)')),
+    (['valor de iss'], searchValue('invoice_tax_iss', MONEY)),
+    (['crédito (r$)', 'credito (r$)'], searchValue('invoice_tax_credit', MONEY)),
+    (['município da prestação do serviço', 'municipio da prestacao do servico'],
+     searchValue('invoice_tax_service_city', r'(?<= do Servi[c|ç]o\s).*')),
+    (['número inscrição da obra', 'numero inscricao da obra'],
+     searchValue('invoice_tax_work_num', r'(?<=da Obra\s).*')),
+    (['valor aproximado dos tributos / fonte'], searchValue('invoice_tax_tribute_value', MONEY)),
+]
+
+
+class LabelMatcher:
+    # Finds which labels of a spec table occur in an OCR chunk. Every distinct label is scored
+    # once per chunk instead of once per spec, and partial_ratio only runs when the characters
+    # shared by chunk and label can reach the threshold: the best window ratio is 2 * LCS /
+    # (len(shorter) + len(window)) and LCS never exceeds that shared count, so skipping those
+    # labels cannot change which fields match.
+
+    def __init__(self, specs, threshold=90):
+        self.threshold = threshold
+        self.labels = {}
+        for labels, extract in specs:
+            for label in labels:
+                self.labels.setdefault(label, Counter(label))
+        self.specs = [(frozenset(labels), extract) for labels, extract in specs]
+
+    def canMatch(self, chunk_counts, chunk_len, label, label_counts, threshold):
+        shared = sum(min(count, chunk_counts[char]) for char, count in label_counts.items())
+        shorter = min(chunk_len, len(label))
+        return 200 * shared > threshold * (shorter + shared)
+
+    def matchedLabels(self, chunk, threshold=None):
+        threshold = self.threshold if threshold is None else threshold
+        chunk_counts = Counter(chunk)
+        matched = set()
+        for label, label_counts in self.labels.items():
+            if self.canMatch(chunk_counts, len(chunk), label, label_counts, threshold) and fuzz.partial_ratio(chunk, label) > threshold:
+                matched.add(label)
+        return matched
+
+    def extract(self, aux):
+        matched = self.matchedLabels(aux.lower())
+        values = {}
+        if matched:
+            for labels, extract in self.specs:
+                if not labels.isdisjoint(matched):
+                    values.update(extract(aux))
+        return values
+
+
+FIELD_MATCHERS = {
+    'RJ': LabelMatcher(RJ_FIELD_SPECS),
+    'SP': LabelMatcher(SP_FIELD_SPECS),
+}
+
+# Fields an invoice is not complete without; for the parties, the one subfield that must be read
+REQUIRED_FIELDS = {
+    'RJ': ['invoice_num', 'invoice_creation', 'invoice_verif_cod', 'invoice_value_raw', 'invoice_calc_base_tax',
+           'invoice_iss_tax', ('invoice_provider', 'doc_number'), ('invoice_client', 'doc_number')],
+    'SP': ['invoice_num', 'invoice_creation', 'invoice_verif_cod', 'invoice_value_raw', 'invoice_tax_calc_base',
+           'invoice_tax_iss', ('invoice_provider', 'doc_number'), ('invoice_client', 'doc_number')],
+}
+
+WHITESPACE_RUN = re.compile(r'\s\s+')
+
+
+def normalizeChunk(value):
+    return WHITESPACE_RUN.sub(' ', value.replace('\n', ' '))
+
+
+def mentionsLabel(text, invoice_city, threshold):
+    # Looser test than extractInvoiceFields, for the quick OCR of a region's first lines
+    return len(FIELD_MATCHERS[invoice_city].matchedLabels(normalizeChunk(text).lower(), threshold)) > 0
+
+
+def matchChunks(raw_data, invoice_city, word_data=None):
+    # For every OCR chunk, (normalized text, fields read from it), or None when it is too short
+    # to hold a field; combineChunks() puts them together into the result of extractInvoiceFields
+    matcher = FIELD_MATCHERS[invoice_city]
+    matches = []
+    for idx, value in enumerate(raw_data):
+        aux = normalizeChunk(value)
+        if len(aux) < 5:
+            matches.append(None)
+            continue
+        values = matcher.extract(aux)
+        if word_data is not None:
+            addConfidences(values, word_data[idx])
+        matches.append((aux, values))
+    return matches
+
+
+def combineChunks(matches, invoice_city):
+    invoice_info = {}
+    invoice_raw_info = []
+    if len(matches) > 0:
+        invoice_info['invoice_city'] = {'value': invoice_city}
+    for match in matches:
+        if match is None:
+            continue
+        aux, values = match
+        invoice_raw_info.append(aux)
+        invoice_info.update(values)
+    return invoice_raw_info, invoice_info
+
+
+def chunkFields(raw_data, invoice_city):
+    # For every OCR chunk, the invoice_info keys extractInvoiceFields takes from it
+    return [set(match[1]) if match is not None else set() for match in matchChunks(raw_data, invoice_city)]
+
+
+def fieldChunks(raw_data, invoice_city):
+    # For every OCR chunk, whether extractInvoiceFields takes at least one field from it
+    return [len(keys) > 0 for keys in chunkFields(raw_data, invoice_city)]
+
+
+def wordConfidence(value, words):
+    # Lowest Tesseract confidence (0-100) among the OCR words the value was read from, None
+    # when the value is empty or none of its words is found
+    if not value:
+        return None
+    tokens = value.split()
+    confidences = [
+        conf for word, conf in words
+        if conf >= 0 and any(word == token or (len(word) > 1 and (word in token or token in word)) for token in tokens)
+    ]
+    return round(min(confidences), 1) if confidences else None
+
+
+def addConfidences(values, words):
+    for field in values.values():
+        if 'value' in field:
+            field['confidence'] = wordConfidence(field['value'], words)
+        else:
+            for subfield in field.values():
+                if isinstance(subfield, dict) and 'value' in subfield:
+                    subfield['confidence'] = wordConfidence(subfield['value'], words)
+
+
+def weakFields(invoice_info, invoice_city, min_confidence):
+    # Required fields that were not read, or read with a confidence below min_confidence
+    weak = set()
+    for required in REQUIRED_FIELDS[invoice_city]:
+        key, subkey = required if isinstance(required, tuple) else (required, None)
+        field = invoice_info.get(key)
+        if field is not None and subkey is not None:
+            field = field.get(subkey)
+        if field is None or field.get('value') is None:
+            weak.add(key)
+        elif field.get('confidence') is not None and field['confidence'] < min_confidence:
+            weak.add(key)
+    return weak
+
+
+def extractInvoiceFields(raw_data, invoice_city, word_data=None):
+    # word_data, when given, holds the OCR words of every chunk as (word, confidence) and adds
+    # a confidence to every field read from them
+    return combineChunks(matchChunks(raw_data, invoice_city, word_data), invoice_city)
@@ -0,0 +1,205 @@
+import json
+import os
+import sqlite3
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    name TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (name, page, stage)
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    record TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sink_file (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+'''
+
+
+def pdfFingerprint(pdf_path):
+    # A PDF replaced under the same name is a new job
+    stat = os.stat(pdf_path)
+    return fr'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+class JobJournal:
+    # Persistent state of every invoice in SQLite (WAL mode, so the watcher loop and the
+    # worker processes read and write it concurrently). A job is queued, running, done,
+    # no_result or failed; a job still queued or running after a crash or restart is retried
+    # and resumes from the stage checkpoints its pages recorded, up to max_attempts times.
+    # With a batch output the extracted records also wait here, in the outbox, for the writer.
+    # Each process opens its own connection, sqlite connections do not survive a fork.
+
+    def __init__(self, path, max_attempts):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.conn = None
+        self.conn_pid = None
+
+    def connection(self):
+        if self.conn is None or self.conn_pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=30)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            with self.conn:
+                self.conn.executescript(SCHEMA)
+            self.conn_pid = os.getpid()
+        return self.conn
+
+    def job(self, name):
+        row = self.connection().execute(
+            'SELECT fingerprint, status, attempts, error FROM jobs WHERE name = ?', (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'fingerprint': row[0], 'status': row[1], 'attempts': row[2], 'error': row[3]}
+
+    def setStatus(self, name, status, error=None):
+        conn = self.connection()
+        with conn:
+            conn.execute('UPDATE jobs SET status = ?, error = ?, updated = ? WHERE name = ?', (status, error, time.time(), name))
+
+    def queue(self, name, fingerprint, result_exists=False):
+        # Returns False when the job must not run again: it is done, had nothing to extract or
+        # already used all its attempts. A new or replaced PDF, or a done one whose result was
+        # removed, starts over; an interrupted one keeps its checkpoints.
+        job = self.job(name)
+        if job is None or job['fingerprint'] != fingerprint or (job['status'] == 'done' and not result_exists):
+            conn = self.connection()
+            with conn:
+                conn.execute('DELETE FROM checkpoints WHERE name = ?', (name,))
+                conn.execute(
+                    'INSERT OR REPLACE INTO jobs (name, fingerprint, status, attempts, error, updated) VALUES (?, ?, ?, 0, NULL, ?)',
+                    (name, fingerprint, 'queued', time.time())
+                )
+            return True
+        if job['status'] in ('done', 'no_result', 'failed'):
+            return False
+        if job['attempts'] >= self.max_attempts:
+            # Given up: its checkpoints are of no use any more, a replaced PDF starts over
+            self.finish(name, 'failed', job['error'] or 'too many attempts')
+            print(fr'Giving up after {job["attempts"]} attempts - File {name}')
+            return False
+        self.setStatus(name, 'queued', job['error'])
+        return True
+
+    def start(self, name):
+        conn = self.connection()
+        with conn:
+            conn.execute('UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ? WHERE name = ?', ('running', time.time(), name))
+
+    def finish(self, name, status, error=None):
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM checkpoints WHERE name = ?', (name,))
+            conn.execute('UPDATE jobs SET status = ?, error = ?, updated = ? WHERE name = ?', (status, error, time.time(), name))
+
+    def fail(self, name, error):
+        # Records why the attempt failed; the job stays running until queue() decides on a retry
+        conn = self.connection()
+        with conn:
+            conn.execute('UPDATE jobs SET error = ?, updated = ? WHERE name = ?', (error, time.time(), name))
+
+    def checkpoints(self, name, page):
+        rows = self.connection().execute(
+            'SELECT stage, value FROM checkpoints WHERE name = ? AND page = ?', (name, page)
+        ).fetchall()
+        return {stage: json.loads(value) for stage, value in rows}
+
+    def checkpoint(self, name, page, stage, value):
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO checkpoints (name, page, stage, value) VALUES (?, ?, ?, ?)',
+                (name, page, stage, json.dumps(value, ensure_ascii=False))
+            )
+
+    def saveResult(self, name, page, record):
+        # The record waits in the outbox for the batch writer; it is added together with the
+        # page's saved checkpoint, so a retry never adds it twice
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                'INSERT INTO outbox (name, page, record, created) VALUES (?, ?, ?, ?)',
+                (name, page, json.dumps(record, ensure_ascii=False), time.time())
+            )
+            for stage in ('result', 'saved'):
+                conn.execute(
+                    'INSERT OR REPLACE INTO checkpoints (name, page, stage, value) VALUES (?, ?, ?, ?)',
+                    (name, page, stage, 'true')
+                )
+
+    def pendingResults(self):
+        rows = self.connection().execute('SELECT id, record FROM outbox ORDER BY id').fetchall()
+        return [(row_id, json.loads(record)) for row_id, record in rows]
+
+    def pendingSize(self):
+        # Total size of the records waiting in the outbox and the age of the oldest one
+        size, oldest = self.connection().execute('SELECT COALESCE(SUM(LENGTH(record)), 0), MIN(created) FROM outbox').fetchone()
+        return size, time.time() - oldest if oldest is not None else 0
+
+    def sinkFile(self):
+        row = self.connection().execute('SELECT path, size, created FROM sink_file').fetchone()
+        return {'path': row[0], 'size': row[1], 'created': row[2]} if row is not None else None
+
+    def commitResults(self, last_id, sink_file):
+        # Drops the records up to last_id, now in the output file, and records how far the
+        # open file (None once closed) is valid
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM outbox WHERE id <= ?', (last_id,))
+            conn.execute('DELETE FROM sink_file')
+            if sink_file is not None:
+                conn.execute(
+                    'INSERT INTO sink_file (path, size, created) VALUES (?, ?, ?)',
+                    (sink_file['path'], sink_file['size'], sink_file['created'])
+                )
+
+
+class PageCheckpoint:
+    # The checkpoints of one page of one job, as extractInvoice reads and writes them; files
+    # such as the rendered page go to directory
+
+    def __init__(self, journal, name, page, directory):
+        self.journal = journal
+        self.name = name
+        self.page = page
+        self.directory = directory
+        self.values = journal.checkpoints(name, page)
+
+    def load(self, stage):
+        return self.values.get(stage)
+
+    def save(self, stage, value):
+        self.journal.checkpoint(self.name, self.page, stage, value)
+        self.values[stage] = value
+
+    def complete(self):
+        # The result of the page is written, a retry skips it and its rendered image can go
+        self.save('saved', True)
+        if self.values.get('image'):
+            try:
+                os.remove(self.values['image'])
+            except OSError:
+                pass
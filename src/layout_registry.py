@@ -0,0 +1,122 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+
+def inkProfiles(img, scale):
+    # Share of ink per row and per column of a reduced page; the table rulings of a layout
+    # are the strong peaks of both profiles
+    small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ink = 1.0 - small.astype(np.float32) / 255.0
+    return ink.mean(axis=1), ink.mean(axis=0)
+
+
+def bestShift(profile, template, max_shift):
+    # Shift of profile against template with the highest normalized correlation
+    a = (profile - profile.mean()) / (profile.std() + 1e-6)
+    b = (template - template.mean()) / (template.std() + 1e-6)
+    n = min(len(a), len(b))
+    best_shift, best_score = 0, -1.0
+    for shift in range(-max_shift, max_shift + 1):
+        if shift >= 0:
+            x, y = a[shift:n], b[:n - shift]
+        else:
+            x, y = a[:n + shift], b[-shift:n]
+        if len(x) == 0:
+            continue
+        score = float(np.dot(x, y) / len(x))
+        if score > best_score:
+            best_shift, best_score = shift, score
+    return best_shift, best_score
+
+
+class LayoutRegistry:
+    # Table box geometry learned per municipality (and render DPI). A new page is aligned to
+    # the stored layout by cross-correlating its row/column ink profiles with the template
+    # ones, which recovers the page offset; the boxes are then cropped directly. The alignment
+    # score is the weaker of the two correlations, below min_score the caller runs the full
+    # detection instead. Skewed scans correlate poorly and fall back the same way.
+
+    def __init__(self, path, min_score, profile_scale=0.125, max_shift_ratio=0.05):
+        self.path = path
+        self.min_score = min_score
+        self.profile_scale = profile_scale
+        self.max_shift_ratio = max_shift_ratio
+        self.templates = {}
+
+    def templatePath(self, city, dpi):
+        return os.path.join(self.path, fr'{city}_{dpi}.json')
+
+    def template(self, city, dpi):
+        template_path = self.templatePath(city, dpi)
+        try:
+            mtime = os.path.getmtime(template_path)
+        except OSError:
+            return None
+        cached = self.templates.get(template_path)
+        if cached is None or cached[0] != mtime:
+            try:
+                with open(template_path, 'r') as template_file:
+                    template = json.load(template_file)
+            except (OSError, ValueError):
+                return None
+            template['rows'] = np.array(template['rows'], dtype=np.float32)
+            template['cols'] = np.array(template['cols'], dtype=np.float32)
+            cached = (mtime, template)
+            self.templates[template_path] = cached
+        return cached[1]
+
+    def fieldFlags(self, city, dpi):
+        # Per box, whether it carried invoice fields when the layout was learned; None for
+        # layouts learned before this was recorded
+        template = self.template(city, dpi)
+        return template.get('fields') if template is not None else None
+
+    def hasTemplate(self, city, dpi):
+        return os.path.exists(self.templatePath(city, dpi))
+
+    def align(self, city, dpi, img):
+        template = self.template(city, dpi)
+        if template is None:
+            return None, 0.0
+
+        height, width = img.shape[:2]
+        template_height, template_width = template['shape']
+        if abs(height - template_height) > 0.02 * template_height or abs(width - template_width) > 0.02 * template_width:
+            return None, 0.0
+
+        rows, cols = inkProfiles(img, self.profile_scale)
+        shift_y, score_y = bestShift(rows, template['rows'], max(1, int(len(rows) * self.max_shift_ratio)))
+        shift_x, score_x = bestShift(cols, template['cols'], max(1, int(len(cols) * self.max_shift_ratio)))
+        score = min(score_y, score_x)
+        if score < self.min_score:
+            return None, score
+
+        offset_x = int(round(shift_x / self.profile_scale))
+        offset_y = int(round(shift_y / self.profile_scale))
+        boxes = []
+        for (x, y, lar, alt) in template['boxes']:
+            x, y = x + offset_x, y + offset_y
+            if x < 0 or y < 0 or x + lar > width or y + alt > height:
+                return None, score
+            boxes.append((x, y, lar, alt))
+        return boxes, score
+
+    def learn(self, city, dpi, img, boxes, fields=None):
+        rows, cols = inkProfiles(img, self.profile_scale)
+        template = {
+            'shape': list(img.shape[:2]),
+            'boxes': [list(box) for box in boxes],
+            'rows': rows.tolist(),
+            'cols': cols.tolist(),
+        }
+        if fields is not None:
+            template['fields'] = list(fields)
+        os.makedirs(self.path, exist_ok=True)
+        template_path = self.templatePath(city, dpi)
+        tmp_path = fr'{template_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as template_file:
+            json.dump(template, template_file)
+        os.replace(tmp_path, template_path)
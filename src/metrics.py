@@ -0,0 +1,272 @@
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_LOG = os.environ.get('NFE_OCR_METRICS_LOG', '')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500)
+CHAR_BUCKETS = (0, 100, 500, 1000, 2500, 5000, 10000, 25000)
+STAGE_VALUE_BUCKETS = {
+    'ocr_chars': CHAR_BUCKETS,
+}
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    # Counters and histograms in Prometheus' data model, safe to update from any thread
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def apply(self, event):
+        key = (event['name'], tuple(sorted(event['labels'].items())))
+        with self.lock:
+            if event['kind'] == 'inc':
+                self.counters[key] = self.counters.get(key, 0) + event['value']
+            else:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = Histogram(tuple(event['buckets']))
+                    self.histograms[key] = histogram
+                histogram.observe(event['value'])
+
+    def snapshot(self):
+        # Every series as JSON-friendly lists, for merge() in another process
+        with self.lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, list(labels), list(histogram.buckets), histogram.counts, histogram.sum, histogram.count]
+                          for (name, labels), histogram in self.histograms.items()]
+        return counters, histograms
+
+    def merge(self, counters, histograms):
+        with self.lock:
+            for name, labels, value in counters:
+                key = (name, tuple(tuple(label) for label in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, buckets, counts, total, count in histograms:
+                key = (name, tuple(tuple(label) for label in labels))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = Histogram(tuple(buckets))
+                    self.histograms[key] = histogram
+                histogram.counts = [have + add for have, add in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+
+    def render(self):
+        lines = []
+        with self.lock:
+            last_name = None
+            for (name, labels), value in sorted(self.counters.items()):
+                if name != last_name:
+                    lines.append(fr'# TYPE {name} counter')
+                    last_name = name
+                lines.append(fr'{name}{formatLabels(labels)} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name != last_name:
+                    lines.append(fr'# TYPE {name} histogram')
+                    last_name = name
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(fr'{name}_bucket{formatLabels(labels + (("le", repr(float(bound))),))} {count}')
+                lines.append(fr'{name}_bucket{formatLabels(labels + (("le", "+Inf"),))} {histogram.count}')
+                lines.append(fr'{name}_sum{formatLabels(labels)} {histogram.sum}')
+                lines.append(fr'{name}_count{formatLabels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def formatLabels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(fr'{key}="{value}"' for key, value in labels) + '}'
+
+
+registry = MetricsRegistry()
+
+# Invoices run in child processes; they sum their events in a registry of their own and send
+# the totals to the process serving /metrics as UDP datagrams on localhost, at most every
+# FORWARD_INTERVAL seconds and when the invoice ends (flushForwarded), so a busy node sends a
+# few datagrams per invoice instead of one per event. A thread of the receiving process
+# merges them as they arrive. Events of a worker killed before its flush are lost.
+FORWARD_BUFFER = 4 * 1024 * 1024
+FORWARD_INTERVAL = 1.0
+FORWARD_SERIES = 100
+
+forward_lock = threading.Lock()
+forward_address = None
+forward_owner = None
+forward_socket = None
+forward_pid = None
+forward_pending = None
+forward_flushed = 0.0
+
+
+def enableForwarding():
+    global forward_address, forward_owner, forward_socket
+    forward_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    forward_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, FORWARD_BUFFER)
+    forward_socket.bind(('127.0.0.1', 0))
+    forward_address = forward_socket.getsockname()
+    forward_owner = os.getpid()
+    thread = threading.Thread(target=receiveForwarded, args=(forward_socket,), name='metrics-forward', daemon=True)
+    thread.start()
+
+
+def receiveForwarded(receive_socket):
+    while True:
+        try:
+            data, _ = receive_socket.recvfrom(65536)
+        except OSError:
+            return
+        try:
+            message = json.loads(data)
+            registry.merge(message['counters'], message['histograms'])
+        except (ValueError, KeyError, TypeError):
+            pass
+
+
+def emit(event):
+    global forward_socket, forward_pid, forward_pending, forward_flushed
+    if forward_address is None or os.getpid() == forward_owner:
+        registry.apply(event)
+        return
+    with forward_lock:
+        if forward_pid != os.getpid():
+            # First event of this child: the socket and totals inherited from the parent are not its own
+            forward_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            forward_pending = MetricsRegistry()
+            forward_pid = os.getpid()
+            forward_flushed = time.monotonic()
+        forward_pending.apply(event)
+        if time.monotonic() - forward_flushed >= FORWARD_INTERVAL:
+            sendPending()
+
+
+def flushForwarded():
+    with forward_lock:
+        if forward_pid == os.getpid():
+            sendPending()
+
+
+def sendPending():
+    # Called with forward_lock held; every datagram carries at most FORWARD_SERIES series
+    global forward_pending, forward_flushed
+    counters, histograms = forward_pending.snapshot()
+    forward_pending = MetricsRegistry()
+    forward_flushed = time.monotonic()
+    series = [('counters', item) for item in counters] + [('histograms', item) for item in histograms]
+    for idx in range(0, len(series), FORWARD_SERIES):
+        message = {'counters': [], 'histograms': []}
+        for kind, item in series[idx:idx + FORWARD_SERIES]:
+            message[kind].append(item)
+        try:
+            forward_socket.sendto(json.dumps(message).encode('utf-8'), forward_address)
+        except OSError:
+            pass
+
+
+def inc(name, labels=None, value=1):
+    emit({'kind': 'inc', 'name': name, 'labels': labels or {}, 'value': value})
+
+
+def observe(name, value, buckets, labels=None):
+    emit({'kind': 'observe', 'name': name, 'labels': labels or {}, 'value': value, 'buckets': list(buckets)})
+
+
+def logEvent(record):
+    if not METRICS_LOG:
+        return
+    # One write per line on an O_APPEND descriptor, so lines of concurrent workers do not mix
+    line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+    fd = os.open(METRICS_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class MeasureStage:
+    # Wraps one pipeline stage: prints the Started/Finished lines, measures it on the monotonic
+    # clock, appends (stage, seconds) to timings and records duration, the values set with
+    # count() and failures in the metrics registry and the JSON-lines log.
+
+    def __init__(self, timings, stage, label, image_name):
+        self.timings = timings
+        self.stage = stage
+        self.label = label
+        self.image_name = image_name
+        self.values = {}
+        self.note = ''
+
+    def count(self, name, value):
+        self.values[name] = value
+
+    def __enter__(self):
+        print(fr'{self.label} Started - File {self.image_name}')
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        status = 'ok' if exc_type is None else 'error'
+        labels = {'stage': self.stage}
+
+        inc('nfe_stage_total', {'stage': self.stage, 'status': status})
+        record = {'ts': time.time(), 'file': self.image_name, 'stage': self.stage, 'status': status, 'seconds': round(seconds, 6)}
+        if exc_type is None:
+            if self.timings is not None:
+                self.timings.append((self.stage, seconds))
+            observe('nfe_stage_duration_seconds', seconds, DURATION_BUCKETS, labels)
+            for name, value in self.values.items():
+                observe(fr'nfe_stage_{name}', value, STAGE_VALUE_BUCKETS.get(name, COUNT_BUCKETS), labels)
+            record.update(self.values)
+            print(fr'{self.label} Finished{self.note} - File {self.image_name} === {seconds}')
+        else:
+            record['error'] = str(exc_value)
+            print(fr'{self.label} Failed - File {self.image_name} === {seconds} - {exc_value}')
+        logEvent(record)
+        return False
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startMetricsServer(port, host='0.0.0.0'):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
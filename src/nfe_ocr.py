@@ -1,563 +1,769 @@
 import cv2
-import json
+import numpy as np
 import os
-import pytesseract
-import re
 import shutil
+import socket
 import time
+from collections import deque, namedtuple
+from cluster import ClusterCoordinator
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from fuzzywuzzy import fuzz
-from pdf2image import convert_from_path
-
-
-def convertPDF2Image(file_name):
-    print(fr'Convert PDF to Image Started - File {file_name}')
-    start = time.time()
-    pages = convert_from_path(fr'./input/{file_name}' + '.pdf', 500)
-    for idx, page in enumerate(pages):
-        page.save(fr'./processing/{file_name}/{file_name}' + '.png', 'PNG')
-        break
-    end = time.time()
-    print(fr'Convert PDF to Image Finished - File {file_name} === {end - start}')
-    markRegion(fr'./processing/{file_name}', file_name)
-
-
-def extractContours(contours, image, dest_path, image_name):
-    print(fr'Extract Contours started - File {file_name}')
-    start = time.time()
-    roi_list = []
-    for idx, c in enumerate(contours):
-        perimeter = cv2.arcLength(c, True)
-        if 1000 < perimeter < 10000:
-            approx = cv2.approxPolyDP(c, 0.03 * perimeter, True)
-            if len(approx) <= 5:
-                (x, y, lar, alt) = cv2.boundingRect(c)
-                raw_roi = image[y - 25:(y + alt) + 25, x - 25:(x + lar) + 25]
-
-                (thresh, roi_final_bin) = cv2.threshold(raw_roi, 190, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
-
-                roi_list.append(fr'{dest_path}/roi_{idx + 1}.png')
-                cv2.imwrite(fr'{dest_path}/roi_{idx + 1}.png', roi_final_bin)
-                cv2.rectangle(image, (x, y), (x + lar, y + alt), (0, 255, 0), 6)
-    end = time.time()
-    print(fr'Extract Contours Finished - File {file_name} === {end - start}')
-    extractTxtFromImage(roi_list, image_name)
-
-
-def markRegion(main_path, image_name):
-    print(fr'Mark Regions Started - File {file_name}')
-    start = time.time()
-
-    alpha = 0.5
-    beta = 1.0 - alpha
-
-    img = cv2.imread(fr'{main_path}/{image_name}.png', 0)
-
-    (thresh, img_bin) = cv2.threshold(img, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
-    img_bin = 255 - img_bin
-
-    verticle_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 9))
-    hori_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (7, 1))
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-
-    img_temp1 = cv2.erode(img_bin, verticle_kernel, iterations=13)
-    verticle_lines_img = cv2.dilate(img_temp1, verticle_kernel, iterations=9, borderValue=10)
-
-    img_temp2 = cv2.erode(img_bin, hori_kernel, iterations=13)
-    horizontal_lines_img = cv2.dilate(img_temp2, hori_kernel, iterations=3)
-
-    img_final_bin = cv2.addWeighted(verticle_lines_img, alpha, horizontal_lines_img, beta, 0.0)
-    img_final_bin = cv2.erode(~img_final_bin, kernel, iterations=3)
-    (thresh, img_final_bin) = cv2.threshold(img_final_bin, 128, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
-
-    img_final_bin = cv2.dilate(
-        ~img_final_bin,
-        cv2.getStructuringElement(cv2.MORPH_ERODE, (5, 5)),
-        iterations=11
-    )
-
-    img_final_bin = cv2.GaussianBlur(~img_final_bin, (5, 5), 5)
-
-    img_final_bin = cv2.erode(
-        ~img_final_bin,
-        cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)),
-        iterations=2
-    )
-
-    contours, hierarchy = cv2.findContours(img_final_bin, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
-
-    end = time.time()
-    print(fr'Mark Regions Finished - File {file_name} === {end - start}')
-    extractContours(contours, img, main_path, image_name)
-
-
-def extractTxtFromImage(image_path_list, image_name):
-    print(fr'Extract txt From Image Started - File {image_name}')
-    start = time.time()
-
-    transc_data = []
-    invoice_city = 'SP' if 'SP' in image_name else 'RJ' if 'RJ' in image_name else None
-    if invoice_city is not None:
-        for path in image_path_list:
-            img_roi_ocr = cv2.imread(path, 0)
-            if img_roi_ocr is not None:
-                config = r'-l eng+por --dpi 150'
-                result = pytesseract.image_to_string(img_roi_ocr, config=config)
-                transc_data.append(result)
-
-        end = time.time()
-        print(fr'Extract txt From Image Finished - File {image_name} === {end - start}')
-        if invoice_city == 'RJ' and len(transc_data) > 0:
-            normalizeRJData(transc_data, image_name)
-        elif invoice_city == 'SP' and len(transc_data) > 0:
-            normalizeSPData(transc_data, image_name)
-
-
-def normalizeRJData(raw_data, image_name):
-    print(fr'Normalize RJ Data Started - File {image_name}')
-    start = time.time()
-
-    invoice_info = {}
-    invoice_raw_info = []
-
-    for idx, value in enumerate(raw_data):
-        aux = re.sub(r'\n', ' ', value)
-        aux = re.sub(r'\s\s+', ' ', aux)
-
-        invoice_info['invoice_city'] = {'value': 'RJ'}
-
-        if len(aux) < 5:
-            continue
-
-        invoice_raw_info.append(aux)
-
-        if fuzz.partial_ratio(aux.lower(), "numero da nota") > 90:
-            key_value = re.search(r'\d+', aux)
-            invoice_info['invoice_num'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "data e hora de emissão") > 90 or fuzz.partial_ratio(aux.lower(), "data e hora de emissao") > 90:
-            key_value = re.search(r'(\d{2})\/(\d{2})\/(\d{4})\s(\d{2}):(\d{2}):(\d{2})', aux)
-            invoice_info['invoice_creation'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "código de verificação") > 90 or fuzz.partial_ratio(aux.lower(), "codigo de verificacao") > 90:
-            key_value = re.search(r'(?<=\s)([\w\|\d]+)-([\w\|\d]+)', aux)
-            invoice_info['invoice_verif_cod'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "prestador de serviços") > 90 or fuzz.partial_ratio(aux.lower(), "prestador de servicos") > 90:
-            doc_number_value = re.search(r'(?<=CPF\/CNPJ:\s)(([0-9]{3}\.?[0-9]{3}\.?[0-9]{3}\-?[0-9]{2}|[0-9]{2}\.?[0-9]{3}\.?[0-9]{3}\/?[0-9]{4}\s?\-?\s?[0-9]{2}))(?=\s)', aux)
-            city_number_value = re.search(r'(?<=Inscrição Municipal:\s)(.*?)(?=\s)', aux)
-            state_number_value = re.search(r'(?<=Inscrição Estadual:\s)(.*?)(?=\s)', aux)
-            main_name_value = re.search(r'(?<=Nome\/Raz[a\|ã]o Social:\s)(.*?)(?=\sNome Fantasia)', aux)
-            sec_name_value = re.search(r'(?<=Nome Fantasia:\s)(.*?)(?=\sTel)', aux)
-            phone_value = re.search(r'(?<=Tel\.:\s)(\(?)(\d{2})(\)?)(\s?)(-?)(\d{4})(\s|-?)(\d{4})(?=\s)()', aux)
-            address_value = re.search(r'(?<=Endereço:\s)(.*?)(?=\sCEP)', aux)
-            zip_code_value = re.search(r'(?<=CEP:\s)(\d{5}-\d{3})', aux)
-            city_value = re.search(r'(?<=Município:\s)(.*?)(?=\sUF)', aux)
-            state_value = re.search(r'(?<=UF:\s)(.*?)(?=\s)', aux)
-            email_value = re.search(r'(?<=E-mail:\s)(.*?)(?=\s)', aux)
-
-            invoice_info['invoice_provider'] = {
-                'doc_number': {'value': doc_number_value.group() if doc_number_value is not None else None},
-                'city_number': {'value': city_number_value.group() if city_number_value is not None else None},
-                'state_number': {'value': state_number_value.group() if state_number_value is not None else None},
-                'main_name': {'value': main_name_value.group() if main_name_value is not None else None},
-                'sec_name': {'value': sec_name_value.group() if sec_name_value is not None else None},
-                'phone': {'value': phone_value.group() if phone_value is not None else None},
-                'address': {'value': address_value.group() if address_value is not None else None},
-                'zip_code': {'value': zip_code_value.group() if zip_code_value is not None else None},
-                'city': {'value': city_value.group() if city_value is not None else None},
-                'state': {'value': state_value.group() if state_value is not None else None},
-                'email': {'value': email_value.group() if email_value is not None else None},
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "tomador de serviços") > 90 or fuzz.partial_ratio(aux.lower(), "tomador de servicos") > 90:
-            doc_number_key_value = re.search(r'(?<=CPF\/CNPJ:\s)(([0-9]{3}\.?[0-9]{3}\.?[0-9]{3}\-?[0-9]{2}|[0-9]{2}\.?[0-9]{3}\.?[0-9]{3}\/?[0-9]{4}\s?\-?\s?[0-9]{2}))(?=\s)', aux)
-            city_number_key_value = re.search(r'(?<=\sMunicipal:\s)(.*?)(?=\s)', aux)
-            state_number_key_value = re.search(r'(?<=Inscriç[a|ã]o Estadual:\s)(.*?)(?=\s)', aux)
-            main_name_key_value = re.search(rf'(?<=Nome\/Raz[a|ã]o Social:\s)(.*?)(?=\sEndere[c|ç]o:)', aux)
-            address_key_value = re.search(r'(?<=Endere[c|ç|g]o:\s)(.*?)(?=\sCEP)', aux)
-            zip_code_key_value = re.search(r'(?<=CEP:\s)(\d{5}-\d{3})', aux)
-            city_key_value = re.search(r'(?<=Munic[í|i]pio:\s)(.*?)(?=\sUF)', aux)
-            state_key_value = re.search(r'(?<=UF:\s)(.*?)(?=\s)', aux)
-            email_key_value = re.search(r'(?<=E-mail:\s)(.*?)(?=\s)', aux)
-
-            invoice_info['invoice_client'] = {
-                'doc_number': {'value': doc_number_key_value.group() if doc_number_key_value is not None else None},
-                'city_number': {'value': city_number_key_value.group() if city_number_key_value is not None else None},
-                'state_number': {'value': state_number_key_value.group() if state_number_key_value is not None else None},
-                'main_name': {'value': main_name_key_value.group() if main_name_key_value is not None else None},
-                'address': {'value': address_key_value.group() if address_key_value is not None else None},
-                'zip_code': {'value': zip_code_key_value.group() if zip_code_key_value is not None else None},
-                'city': {'value': city_key_value.group() if city_key_value is not None else None},
-                'state': {'value': state_key_value.group() if state_key_value is not None else None},
-                'email': {'value': email_key_value.group() if email_key_value is not None else None},
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "discriminação dos serviços") > 90 or fuzz.partial_ratio(aux.lower(), "discriminacao dos servicos") > 90:
-            order_number = None
-            order_number_paterns = [r'[N|n][º] [D|d][O|o] [P|p][E|e][D|d][I|i][D|d][O|o]',
-                                    r'[O|o][R|r][D|d][E|e][M|m] [D|d][E|e] [C|c][O|o][M|m][P|p][R|r][A|a]',
-                                    r'[P|p][E|e][D|d][I|i][D|d][O|o] [D|d][E|e] [C|c][O|o][M|m][P|p][R|r][A|a]',
-                                    r'[P|p][E|e][D|d][I|i][D|d][O|o] [D|d][O|o] [P|p][E|e][D|d][I|i][D|d][O|o]',
-                                    r'[P|p][E|e][D|d][I|i][D|d][O|o] [O|o][C|c]',
-                                    r'[P|p][E|e][D|d][I|i][D|d][O|o]']
-
-            for op in order_number_paterns:
-                if order_number is None:
-                    order_number = re.search(fr'(?<={op}:\s)(.*?)(?=\s)', aux)
-                    if order_number is not None:
-                        order_number = order_number.group()
-                        break
-
-            invoice_info['invoice_description'] = {
-                'order_number': order_number,
-                'raw': aux
-            }
-
-            olv_pattern = r'[V|v][A|a][L|l][O|o][R|r] [L|l][I|i][Q|q][U|u][I|Í|i|í][D|d][O|o]'
-            key_value_aux = re.search(fr'(?<={olv_pattern}).*', aux)
-            key_value_aux = key_value_aux.group() if key_value_aux is not None else ''
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}(?=\s)', key_value_aux)
-
-            invoice_info['invoice_value_liq'] = {
-                'value': key_value.group() if key_value is not None else None,
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "valor da nota") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_value_raw'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "serviço prestado") > 90 or fuzz.partial_ratio(aux.lower(), "servico prestado") > 90:
-            key_value = re.search(r'(?<=Prestado\s)(\d+\.\d+\.\d).*', aux)
-            invoice_info['invoice_service'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "deduções") > 90 or fuzz.partial_ratio(aux.lower(), "deducoes") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_deduc'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "desconto incond.") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_discount'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "base de cálculo") > 90 or fuzz.partial_ratio(aux.lower(), "base de calculo") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_calc_base_tax'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "aliquota") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}(\s?%?)', aux)
-            invoice_info['invoice_aliq_tax'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "valor de iss") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_iss_tax'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "crédito p/ iptu") > 90 or fuzz.partial_ratio(aux.lower(), "credito p/ iptu") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_iptu_credit'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-    end = time.time()
-    print(fr'Normalize RJ Data Finished - File {image_name} === {end - start}')
-    saveProcessResult(invoice_raw_info, invoice_info, image_name)
-    # return invoice_info
-
-
-def normalizeSPData(raw_data, image_name):
-    print(fr'Normalize SP Data Started - File {image_name}')
-    start = time.time()
-
-    invoice_info = {}
-    invoice_raw_info = []
-
-    for idx, value in enumerate(raw_data):
-        aux = re.sub(r'\n', ' ', value)
-        aux = re.sub(r'\s\s+', ' ', aux)
-
-        invoice_info['invoice_city'] = {'value': 'SP'}
-
-        if len(aux) < 5:
-            continue
-
-        invoice_raw_info.append(aux)
-
-        if fuzz.partial_ratio(aux.lower(), "numero da nota") > 90:
-            key_value = re.search(r'\d+', aux)
-            invoice_info['invoice_num'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "data e hora de emissão") > 90 or fuzz.partial_ratio(aux.lower(), "data e hora de emissao") > 90:
-            key_value = re.search(r'(\d{2})\/(\d{2})\/(\d{4})\s(\d{2}):(\d{2}):(\d{2})', aux)
-            invoice_info['invoice_creation'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "código de verificação") > 90 or fuzz.partial_ratio(aux.lower(), "codigo de verificacao") > 90:
-            key_value = re.search(r'(?<=\s)([\w\|\d]+)-([\w\|\d]+)', aux)
-            invoice_info['invoice_verif_cod'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "prestador de serviços") > 90 or fuzz.partial_ratio(aux.lower(), "prestador de servicos") > 90:
-            doc_number_value = re.search(r'(?<=CPF\/CNPJ:\s)(([0-9]{3}\.?[0-9]{3}\.?[0-9]{3}\-?[0-9]{2}|[0-9]{2}\.?[0-9]{3}\.?[0-9]{3}\/?[0-9]{4}\s?\-?\s?[0-9]{2}))(?=\s)', aux)
-            city_number_value = re.search(r'(?<=Inscri[c|ç][a|ã]o Municipal:\s)(.*?)(?=\s)', aux)
-            main_name_value = re.findall(r'(?:Nome\/[A-zÀ-ÿ]+?\sSocial.\s)(.*)(?=\sEndere[c|ç]o)', aux)
-            address_value = re.search(r'(?<=Endere[c|ç]o:\s)(.*?)(?=\sCEP)', aux)
-            zip_code_value = re.search(r'(?<=CEP:\s)(\d{5}-\d{3})', aux)
-            city_value = re.search(r'(?<=Munic[i|í]pio:\s)(.*?)(?=\sUF)', aux)
-            state_value = re.search(r'(?<=UF:\s)(.*?)(?=\s)', aux)
-
-            invoice_info['invoice_provider'] = {
-                'doc_number': {'value': doc_number_value.group() if doc_number_value is not None else None},
-                'city_number': {'value': city_number_value.group() if city_number_value is not None else None},
-                'main_name': {'value': main_name_value[0] if len(main_name_value) > 0 else None},
-                'address': {'value': address_value.group() if address_value is not None else None},
-                'zip_code': {'value': zip_code_value.group() if zip_code_value is not None else None},
-                'city': {'value': city_value.group() if city_value is not None else None},
-                'state': {'value': state_value.group() if state_value is not None else None},
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "tomador de serviços") > 90 or fuzz.partial_ratio(aux.lower(), "tomador de servicos") > 90:
-            main_name_key_value = re.findall(r'(?:Nome\/[A-zÀ-ÿ]+?\sSocial.\s)(.*)(?=\sCPF\/CNPJ.)', aux)
-            doc_number_key_value = re.search(r'(?<=CPF\/CNPJ:\s)(([0-9]{3}\.?[0-9]{3}\.?[0-9]{3}\-?[0-9]{2}|[0-9]{2}\.?[0-9]{3}\.?[0-9]{3}\/?[0-9]{4}\s?\-?\s?[0-9]{2}))(?=\s)', aux)
-            city_number_key_value = re.search(r'(?<=\sMunicipal:\s)(.*?)(?=\s)', aux)
-            address_key_value = re.search(r'(?<=Endere[c|ç|g]o:\s)(.*?)(?=\sCEP)', aux)
-            zip_code_key_value = re.search(r'(?<=CEP:\s)(\d{5}-\d{3})', aux)
-            city_key_value = re.search(r'(?<=Munic[í|i]pio:\s)(.*?)(?=\sUF)', aux)
-            state_key_value = re.search(r'(?<=UF:\s)(.*?)(?=\s)', aux)
-            email_key_value = re.search(r'(?<=E-mail:\s)(.*?)(?=\s)', aux)
-
-            invoice_info['invoice_client'] = {
-                'main_name': {'value': main_name_key_value[0] if len(main_name_key_value) > 0 else None},
-                'doc_number': {'value': doc_number_key_value.group() if doc_number_key_value is not None else None},
-                'city_number': {'value': city_number_key_value.group() if city_number_key_value is not None else None},
-                'address': {'value': address_key_value.group() if address_key_value is not None else None},
-                'zip_code': {'value': zip_code_key_value.group() if zip_code_key_value is not None else None},
-                'city': {'value': city_key_value.group() if city_key_value is not None else None},
-                'state': {'value': state_key_value.group() if state_key_value is not None else None},
-                'email': {'value': email_key_value.group() if email_key_value is not None else None},
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "discriminação dos serviços") > 90 or fuzz.partial_ratio(aux.lower(), "discriminacao dos servicos") > 90:
-            order_number = None
-            order_number_paterns = [r'[N|n][º] [D|d][O|o] [P|p][E|e][D|d][I|i][D|d][O|o]',
-                                    r'[O|o][R|r][D|d][E|e][M|m] [D|d][E|e] [C|c][O|o][M|m][P|p][R|r][A|a]',
-                                    r'[P|p][E|e][D|d][I|i][D|d][O|o] [D|d][E|e] [C|c][O|o][M|m][P|p][R|r][A|a]',
-                                    r'[P|p][E|e][D|d][I|i][D|d][O|o] [D|d][O|o] [P|p][E|e][D|d][I|i][D|d][O|o]',
-                                    r'[P|p][E|e][D|d][I|i][D|d][O|o] [O|o][C|c]',
-                                    r'[P|p][E|e][D|d][I|i][D|d][O|o]']
-
-            for op in order_number_paterns:
-                if order_number is None:
-                    order_number = re.search(fr'(?<={op}:\s)(.*?)(?=\s)', aux)
-                    if order_number is not None:
-                        order_number = order_number.group()
-                        break
-
-            invoice_info['invoice_description'] = {
-                'order_number': order_number,
-                'raw': aux
-            }
-
-            olv_pattern = r'[V|v][A|a][L|l][O|o][R|r] [L|l][I|i][Q|q][U|u][I|Í|i|í][D|d][O|o]'
-            key_value_aux = re.search(fr'(?<={olv_pattern}).*', aux)
-            key_value_aux = key_value_aux.group() if key_value_aux is not None else ''
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}(?=\s)', key_value_aux)
-
-            invoice_info['invoice_value_liq'] = {
-                'value': key_value.group() if key_value is not None else None,
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "valor total do serviço") > 90 or fuzz.partial_ratio(aux.lower(), "valor total do servico") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_value_raw'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "inss") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_tax_inss'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "irrf") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_tax_irrf'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "csll") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_tax_csll'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "cofins") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_tax_cofins'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "pis/pasep") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_tax_pis-pasep'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "código do serviço") > 90 or fuzz.partial_ratio(aux.lower(), "código do servico") > 90:
-            key_value = re.search(r'(?<=\s)(\d+).*', aux)
-            invoice_info['invoice_service'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "valor total das deduções") > 90 or fuzz.partial_ratio(aux.lower(), "valor total das deducoes") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_tax_deductions'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "base de cálculo") > 90 or fuzz.partial_ratio(aux.lower(), "base de calculo") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_tax_calc_base'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "aliquota") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}(\s?%?)', aux)
-            invoice_info['invoice_tax_aliq'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "valor de iss") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_tax_iss'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "crédito (r$)") > 90 or fuzz.partial_ratio(aux.lower(), "credito (r$)") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_tax_credit'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "município da prestação do serviço") > 90 or fuzz.partial_ratio(aux.lower(), "municipio da prestacao do servico") > 90:
-            key_value = re.search(r'(?<= do Servi[c|ç]o\s).*', aux)
-            invoice_info['invoice_tax_service_city'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "número inscrição da obra") > 90 or fuzz.partial_ratio(aux.lower(), "numero inscricao da obra") > 90:
-            key_value = re.search(r'(?<=da Obra\s).*', aux)
-            invoice_info['invoice_tax_work_num'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-        if fuzz.partial_ratio(aux.lower(), "valor aproximado dos tributos / fonte") > 90:
-            key_value = re.search(r'(0|[1-9]\d{0,2}(\.\d{3})*),\d{2}', aux)
-            invoice_info['invoice_tax_tribute_value'] = {
-                'value': key_value.group() if key_value is not None else None,
-                'raw': aux
-            }
-
-    end = time.time()
-    print(fr'Normalize SP Data Finished - File {image_name} === {end - start}')
-    saveProcessResult(invoice_raw_info, invoice_info, image_name)
-    # return invoice_info
-
-
-def saveProcessResult(result_raw_obj, result_obj, image_name):
-    print(fr'Save Result Started - File {image_name}')
-    start = time.time()
-
-    json_string = json.dumps(result_obj, indent=2, sort_keys=True, ensure_ascii=False)
-    json_file = open(fr'./input/{image_name}.json', 'w')
-    json_file.write(json_string)
-    json_file.close()
-
-    text_file = open(fr'./input/{image_name}.txt', 'w')
-    for el in result_raw_obj:
-        text_file.write(el + '\n')
-    text_file.close()
-
-    shutil.rmtree(fr'./processing/{image_name}')
-
-    end = time.time()
-    print(fr'Save Result Finished - File {image_name} === {end - start}')
+from functools import lru_cache
+from input_watcher import InputWatcher
+from invoice_fields import combineChunks, fieldChunks, matchChunks, mentionsLabel, weakFields
+from job_journal import JobJournal, PageCheckpoint, pdfFingerprint
+from layout_registry import LayoutRegistry
+from output_sink import BatchSink, FileSink
+from metrics import enableForwarding, inc, MeasureStage, startMetricsServer
+from ocr_engine import OCR_BACKEND, OCR_THREADS, ocrImages, preloadEngines
+from pdf_pages import PdfPages
+from result_cache import ResultCache
+from scheduler import InvoiceScheduler
+from text_layer import readPdfWords, wordsInBoxes
+
+PIPELINE_VERSION = '2'
+
+RENDER_DPI = int(os.environ.get('NFE_OCR_DPI', 500))
+DETECT_SCALE = float(os.environ.get('NFE_OCR_DETECT_SCALE', 1.0))
+LAYOUT_CACHE = os.environ.get('NFE_OCR_LAYOUT_CACHE', '1') == '1'
+LAYOUT_DIR = os.environ.get('NFE_OCR_LAYOUT_DIR', './layouts')
+LAYOUT_MIN_SCORE = float(os.environ.get('NFE_OCR_LAYOUT_MIN_SCORE', 0.8))
+LAYOUT_MIN_FIELDS = int(os.environ.get('NFE_OCR_LAYOUT_MIN_FIELDS', 8))
+TEXT_LAYER = os.environ.get('NFE_OCR_TEXT_LAYER', '1') == '1'
+TEXT_LAYER_DPI = int(os.environ.get('NFE_OCR_TEXT_LAYER_DPI', 150))
+TEXT_LAYER_MIN_WORDS = int(os.environ.get('NFE_OCR_TEXT_LAYER_MIN_WORDS', 30))
+WORKERS = int(os.environ.get('NFE_OCR_WORKERS', os.cpu_count() or 1))
+FILE_TIMEOUT = int(os.environ.get('NFE_OCR_FILE_TIMEOUT', 600))
+QUEUE_SIZE = int(os.environ.get('NFE_OCR_QUEUE_SIZE', 100))
+DEBUG_DIR = os.environ.get('NFE_OCR_DEBUG_DIR', '')
+POLL_INTERVAL = int(os.environ.get('NFE_OCR_POLL_INTERVAL', 5))
+RESCAN_INTERVAL = int(os.environ.get('NFE_OCR_RESCAN_INTERVAL', 300))
+METRICS_PORT = int(os.environ.get('NFE_OCR_METRICS_PORT', 9108))
+CACHE_DIR = os.environ.get('NFE_OCR_CACHE_DIR', './cache')
+CACHE_MAX_MB = int(os.environ.get('NFE_OCR_CACHE_MAX_MB', 512))
+CACHE_ROI_TEXT = os.environ.get('NFE_OCR_CACHE_ROI_TEXT', '0') == '1'
+JOURNAL_PATH = os.environ.get('NFE_OCR_JOURNAL', './processing/journal.db')
+MAX_ATTEMPTS = int(os.environ.get('NFE_OCR_MAX_ATTEMPTS', 3))
+CHECKPOINT_IMAGES = os.environ.get('NFE_OCR_CHECKPOINT_IMAGES', '1') == '1'
+ROI_FILTER = os.environ.get('NFE_OCR_ROI_FILTER', '1') == '1'
+ROI_HEADER_INCHES = 0.35
+ROI_HEADER_SCALE = 0.5
+ROI_HEADER_THRESHOLD = 75
+ROI_PREPROCESS = os.environ.get('NFE_OCR_ROI_PREPROCESS', 'adaptive')
+ROI_TEXT_HEIGHT = int(os.environ.get('NFE_OCR_ROI_TEXT_HEIGHT', 26))
+OCR_TIERED = os.environ.get('NFE_OCR_TIERED', '1') == '1'
+OCR_FAST_TEXT_HEIGHT = int(os.environ.get('NFE_OCR_FAST_TEXT_HEIGHT', 18))
+OCR_MIN_CONFIDENCE = float(os.environ.get('NFE_OCR_MIN_CONFIDENCE', 60))
+CLUSTER = os.environ.get('NFE_OCR_CLUSTER', '0') == '1'
+NODE_ID = os.environ.get('NFE_OCR_NODE_ID', '') or socket.gethostname()
+CLAIM_DIR = os.environ.get('NFE_OCR_CLAIM_DIR', './input/.claims')
+LEASE_SECONDS = int(os.environ.get('NFE_OCR_LEASE_SECONDS', 60))
+HEARTBEAT_INTERVAL = max(1, LEASE_SECONDS // 4)
+RETRY_SECONDS = int(os.environ.get('NFE_OCR_RETRY_SECONDS', 30))
+OUTPUT = os.environ.get('NFE_OCR_OUTPUT', 'files')
+OUTPUT_DIR = os.environ.get('NFE_OCR_OUTPUT_DIR', './input/results')
+OUTPUT_ROLL_MB = int(os.environ.get('NFE_OCR_OUTPUT_ROLL_MB', 64))
+OUTPUT_ROLL_SECONDS = int(os.environ.get('NFE_OCR_OUTPUT_ROLL_SECONDS', 3600))
+
+result_cache = ResultCache(CACHE_DIR, CACHE_MAX_MB * 1024 * 1024, fr'{PIPELINE_VERSION}|dpi={RENDER_DPI}|scale={DETECT_SCALE}|text={TEXT_LAYER}:{TEXT_LAYER_DPI}|layout={LAYOUT_CACHE}|filter={ROI_FILTER}|prep={ROI_PREPROCESS}:{ROI_TEXT_HEIGHT}|tiered={OCR_TIERED}:{OCR_FAST_TEXT_HEIGHT}:{OCR_MIN_CONFIDENCE}|ocr={OCR_BACKEND}')
+
+layout_registry = LayoutRegistry(LAYOUT_DIR, LAYOUT_MIN_SCORE)
+
+job_journal = JobJournal(JOURNAL_PATH, MAX_ATTEMPTS)
+
+if OUTPUT == 'files':
+    output_sink = FileSink('./input')
+else:
+    output_sink = BatchSink(OUTPUT_DIR, OUTPUT, OUTPUT_ROLL_MB * 1024 * 1024, OUTPUT_ROLL_SECONDS, job_journal, fr'invoices_{NODE_ID}')
+
+# A table cell cut from the page: index follows the contour order, bbox is (x, y, width, height)
+# in page pixels and crop is a view into the page array with a 25 px margin
+Roi = namedtuple('Roi', ['index', 'bbox', 'crop'])
+
+
+def printTimingReport(image_name, timings):
+    total = sum(seconds for stage, seconds in timings)
+    print(fr'Timing Report - File {image_name}')
+    for stage, seconds in timings:
+        share = 100 * seconds / total if total > 0 else 0.0
+        print(fr'    {stage:<24} {seconds:8.3f}s {share:5.1f}%')
+    print(fr'    {"total":<24} {total:8.3f}s')
+
+
+def renderPage(source, dpi, page=1):
+    # poppler rasterizes just the requested page, already in grayscale. A PdfPages source reuses
+    # its page buffer, a path or PDF bytes is opened for this page only
+    if isinstance(source, PdfPages):
+        return source.render(page, dpi)
+    with PdfPages(source) as pages:
+        return pages.render(page, dpi)
+
+
+def convertPDF2Image(source, image_name, dpi=RENDER_DPI, timings=None, page=1):
+    with MeasureStage(timings, 'convert_pdf', 'Convert PDF to Image', image_name):
+        img = renderPage(source, dpi, page)
+    return img
+
+
+def binarizeRoi(roi):
+    (thresh, roi_final_bin) = cv2.threshold(roi.crop, 190, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    return roi_final_bin
+
+
+def glyphRows(ink):
+    # Median height of the connected components shaped like characters (table rulings and
+    # specks are left out) and how many rows of text their vertical centers form. None when
+    # the region has too little text to tell.
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    glyphs = (heights >= 8) & (heights <= RENDER_DPI // 2) & (widths <= 3 * heights) & (8 * widths >= heights)
+    if np.count_nonzero(glyphs) < 3:
+        return None, 0
+    glyph_height = float(np.median(heights[glyphs]))
+    centers = np.sort(centroids[1:, 1][glyphs])
+    rows = 1 + int(np.count_nonzero(np.diff(centers) > 0.8 * glyph_height))
+    return glyph_height, rows
+
+
+def prepareRoi(roi, text_height=ROI_TEXT_HEIGHT):
+    # Tesseract reads best with glyphs around text_height px: larger crops are reduced to that,
+    # the resolution that results is declared instead of a fixed one, and boxes with a single
+    # row of text are read as one line instead of running the page layout analysis.
+    (thresh, ink) = cv2.threshold(roi.crop, 190, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    glyph_height, rows = glyphRows(ink)
+    if glyph_height is None:
+        return binarizeRoi(roi), RENDER_DPI, None
+    scale = min(1.0, text_height / glyph_height)
+    img = roi.crop if scale == 1.0 else cv2.resize(roi.crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    (thresh, img_bin) = cv2.threshold(img, 190, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    psm = 7 if rows == 1 else 6
+    return img_bin, max(70, int(round(RENDER_DPI * scale))), psm
+
+
+def fastRoi(roi):
+    # First tier of the tiered OCR: smaller glyphs, about twice as fast to read
+    return prepareRoi(roi, OCR_FAST_TEXT_HEIGHT)
+
+
+def fullRoi(roi):
+    # Second tier: the region at full render resolution, with Tesseract's own layout analysis
+    return binarizeRoi(roi), RENDER_DPI, None
+
+
+def dumpRois(image, roi_list, image_name):
+    dest_path = os.path.join(DEBUG_DIR, image_name)
+    os.makedirs(dest_path, exist_ok=True)
+    page = image.copy()
+    for roi in roi_list:
+        (x, y, lar, alt) = roi.bbox
+        cv2.imwrite(fr'{dest_path}/roi_{roi.index}.png', binarizeRoi(roi))
+        cv2.rectangle(page, (x, y), (x + lar, y + alt), (0, 255, 0), 6)
+    cv2.imwrite(fr'{dest_path}/{image_name}.png', page)
+
+
+def tableBox(contour):
+    perimeter = cv2.arcLength(contour, True)
+    if 1000 < perimeter < 10000:
+        approx = cv2.approxPolyDP(contour, 0.03 * perimeter, True)
+        if len(approx) <= 5:
+            return cv2.boundingRect(contour)
+    return None
+
+
+def cropRoi(image, index, box):
+    (x, y, lar, alt) = box
+    return Roi(index, box, image[y - 25:(y + alt) + 25, x - 25:(x + lar) + 25])
+
+
+def matchLayout(img, city, image_name, timings=None, layouts=layout_registry):
+    # Crops the boxes of the city's learned layout when the page aligns with it, None otherwise
+    with MeasureStage(timings, 'match_layout', 'Match Layout', image_name) as stage:
+        boxes, score = layouts.align(city, RENDER_DPI, img)
+        roi_list = None
+        if boxes is not None:
+            roi_list = [cropRoi(img, idx + 1, box) for idx, box in enumerate(boxes)]
+            if DEBUG_DIR:
+                dumpRois(img, roi_list, image_name)
+            stage.count('rois', len(roi_list))
+        inc('nfe_layout_matches_total', {'city': city, 'result': 'used' if roi_list is not None else 'not_used'})
+        stage.note = fr' ({"used" if roi_list is not None else "not used"}, score {score:.2f})'
+    return roi_list
+
+
+def extractContours(contours, image, image_name, timings=None):
+    with MeasureStage(timings, 'extract_contours', 'Extract Contours', image_name) as stage:
+        roi_list = []
+        for idx, c in enumerate(contours):
+            box = tableBox(c)
+            if box is not None:
+                roi_list.append(cropRoi(image, idx + 1, box))
+        if DEBUG_DIR:
+            dumpRois(image, roi_list, image_name)
+        stage.count('contours', len(contours))
+        stage.count('rois', len(roi_list))
+    return roi_list
+
+
+def roiHeader(roi):
+    # First lines of the region, where the field labels are, reduced for the quick OCR pass
+    strip = roi.crop[:25 + int(ROI_HEADER_INCHES * RENDER_DPI)]
+    strip = cv2.resize(strip, None, fx=ROI_HEADER_SCALE, fy=ROI_HEADER_SCALE, interpolation=cv2.INTER_AREA)
+    (thresh, strip_bin) = cv2.threshold(strip, 190, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    return strip_bin, int(RENDER_DPI * ROI_HEADER_SCALE), 6
+
+
+def classifyRois(roi_list, city, image_name, timings=None, layout_fields=None):
+    # Keeps the regions that carry labels of the city's fields, the only ones the normalizers
+    # use, so the full OCR skips the rest. The regions of a learned layout are known already;
+    # the others are judged on a quick OCR of their first lines. When nothing looks like a
+    # label the page is unusual and every region is kept.
+    with MeasureStage(timings, 'classify_rois', 'Classify Regions', image_name) as stage:
+        if layout_fields is not None and len(layout_fields) == len(roi_list):
+            method = 'layout'
+            wanted = [roi for roi, has_fields in zip(roi_list, layout_fields) if has_fields]
+        else:
+            method = 'header'
+            headers = ocrImages(roi_list, OCR_THREADS, preprocess=roiHeader, profile='header')
+            wanted = [roi for roi, header in zip(roi_list, headers) if mentionsLabel(header, city, ROI_HEADER_THRESHOLD)]
+        if len(wanted) == 0:
+            wanted = roi_list
+        skipped = len(roi_list) - len(wanted)
+        inc('nfe_rois_skipped_total', {'method': method}, skipped)
+        stage.count('rois_skipped', skipped)
+        stage.note = fr' ({method}, {skipped} of {len(roi_list)} skipped)'
+    return wanted
+
+
+def oddSize(size, scale):
+    # Kernels keep an odd size when scaled, an even one would shift the boxes by half its size
+    size = max(1, round(size * scale))
+    return size if size % 2 == 1 else size + 1
+
+
+def rectKernel(width, height, iterations=1, scale=1.0):
+    # n passes of a width x height rectangle equal one pass of this larger rectangle
+    width = width + (iterations - 1) * (width - 1)
+    height = height + (iterations - 1) * (height - 1)
+    return cv2.getStructuringElement(cv2.MORPH_RECT, (oddSize(width, scale), oddSize(height, scale)))
+
+
+@lru_cache(maxsize=None)
+def tableKernels(scale):
+    return {
+        'vertical_erode': rectKernel(1, 9, 13, scale),
+        'vertical_dilate': rectKernel(1, 9, 9, scale),
+        'horizontal_erode': rectKernel(7, 1, 13, scale),
+        'horizontal_dilate': rectKernel(7, 1, 3, scale),
+        'merge_erode': rectKernel(3, 3, 3, scale),
+        'box_dilate': rectKernel(5, 5, 11, scale),
+        'smooth_erode': cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (oddSize(5, scale), oddSize(5, scale))),
+        'blur': ((oddSize(5, scale), oddSize(5, scale)), 5 * scale),
+    }
+
+
+def findTableContours(img, scale=DETECT_SCALE, prescaled=False):
+    # Same chain of operations markRegion always used, with every repeated rectangular
+    # erode/dilate folded into one pass of the equivalent larger kernel. With scale < 1 the
+    # page is reduced first (unless it was rendered at that scale already, prescaled), every
+    # kernel and the blur shrink with it and the contours are mapped back to full resolution.
+    kernels = tableKernels(scale)
+    work = img if scale == 1.0 or prescaled else cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    (thresh, img_bin) = cv2.threshold(work, 128, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+
+    verticle_lines_img = cv2.erode(img_bin, kernels['vertical_erode'])
+    verticle_lines_img = cv2.dilate(verticle_lines_img, kernels['vertical_dilate'], borderValue=10)
+
+    horizontal_lines_img = cv2.erode(img_bin, kernels['horizontal_erode'])
+    horizontal_lines_img = cv2.dilate(horizontal_lines_img, kernels['horizontal_dilate'])
+
+    img_final_bin = cv2.addWeighted(verticle_lines_img, 0.5, horizontal_lines_img, 0.5, 0.0)
+    img_final_bin = cv2.erode(~img_final_bin, kernels['merge_erode'])
+    (thresh, img_final_bin) = cv2.threshold(img_final_bin, 128, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+
+    img_final_bin = cv2.dilate(img_final_bin, kernels['box_dilate'])
+    img_final_bin = cv2.GaussianBlur(~img_final_bin, *kernels['blur'])
+    img_final_bin = cv2.erode(~img_final_bin, kernels['smooth_erode'], iterations=2)
+
+    contours, hierarchy = cv2.findContours(img_final_bin, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    if scale != 1.0:
+        # A reduced pixel covers 1 / scale full resolution pixels, its center maps to their center
+        contours = [np.rint((c + 0.5) / scale - 0.5).astype(np.int32) for c in contours]
+    return contours
+
+
+def markRegion(img, image_name, timings=None):
+    with MeasureStage(timings, 'mark_region', 'Mark Regions', image_name):
+        contours = findTableContours(img)
+    return contours
+
+
+def extractTextLayer(source, image_name, timings=None, page=1):
+    # Digitally generated NFS-e already carry their text: the table boxes are found on a low
+    # resolution render and filled with the embedded words instead of OCR. Returns None when
+    # there is no usable text layer, so the caller falls back to rasterize + OCR.
+    with MeasureStage(timings, 'extract_text_layer', 'Extract Text Layer', image_name) as stage:
+        roi_text = None
+        words = readPdfWords(source.path if isinstance(source, PdfPages) else source, page)
+        if len(words) >= TEXT_LAYER_MIN_WORDS:
+            scale = TEXT_LAYER_DPI / RENDER_DPI
+            img = renderPage(source, TEXT_LAYER_DPI, page)
+            boxes = [tableBox(c) for c in findTableContours(img, scale, prescaled=True)]
+            boxes = [box for box in boxes if box is not None]
+            if len(boxes) > 0:
+                roi_text = wordsInBoxes(words, boxes, RENDER_DPI / 72)
+                stage.count('rois', len(boxes))
+        stage.count('words', len(words))
+        inc('nfe_text_layer_total', {'result': 'used' if roi_text is not None else 'not_usable'})
+        stage.note = fr' ({"used" if roi_text is not None else "not usable"}, {len(words)} words)'
+    return roi_text
+
+
+def extractTxtFromImage(roi_list, image_name, timings=None, word_data=None, preprocess=None):
+    # word_data, when given, receives the (word, confidence) pairs of every region
+    with MeasureStage(timings, 'extract_txt', 'Extract txt From Image', image_name) as stage:
+        if preprocess is None:
+            preprocess = prepareRoi if ROI_PREPROCESS == 'adaptive' else binarizeRoi
+        # Results come back in roi_list order, which the normalizers rely on
+        results = ocrImages(roi_list, OCR_THREADS, preprocess=preprocess, with_data=True)
+        transc_data = [text for text, words in results]
+        if word_data is not None:
+            word_data.extend(words for text, words in results)
+        stage.count('rois', len(roi_list))
+        stage.count('ocr_chars', sum(len(text) for text in transc_data))
+    return transc_data
+
+
+def escalateOcr(roi_list, transc_data, word_data, city, image_name, timings=None):
+    # Second tier of the tiered OCR: the regions behind required fields that the fast pass did
+    # not read, or read below OCR_MIN_CONFIDENCE, are transcribed again at full resolution and
+    # replace the fast result. A field whose label was not found at all points to no region,
+    # so the regions that produced no field are retried for it. Returns the text with the fields
+    # matched in every region (see matchChunks), which the normalizer takes as they are.
+    with MeasureStage(timings, 'escalate_ocr', 'Escalate OCR', image_name) as stage:
+        matches = matchChunks(transc_data, city, word_data)
+        weak = weakFields(combineChunks(matches, city)[1], city, OCR_MIN_CONFIDENCE)
+        targets = []
+        if weak:
+            chunk_keys = [set(match[1]) if match is not None else set() for match in matches]
+            unplaced = weak - set().union(*chunk_keys)
+            targets = [idx for idx, keys in enumerate(chunk_keys) if keys & weak or (unplaced and not keys)]
+        if targets:
+            results = ocrImages([roi_list[idx] for idx in targets], OCR_THREADS, preprocess=fullRoi, with_data=True)
+            for idx, (text, words) in zip(targets, results):
+                transc_data[idx] = text
+                word_data[idx] = words
+            for idx, match in zip(targets, matchChunks([transc_data[idx] for idx in targets], city, [word_data[idx] for idx in targets])):
+                matches[idx] = match
+        inc('nfe_ocr_tier_total', {'result': 'escalated' if targets else 'fast_only'})
+        inc('nfe_ocr_escalated_rois_total', value=len(targets))
+        stage.count('weak_fields', len(weak))
+        stage.count('rois', len(targets))
+        stage.note = fr' ({len(targets)} of {len(roi_list)} regions, weak: {", ".join(sorted(weak)) or "none"})'
+    return transc_data, matches
+
+
+def normalizeRJData(raw_data, image_name, timings=None, word_data=None, matches=None):
+    # matches, when given, are the fields escalateOcr already read from raw_data
+    with MeasureStage(timings, 'normalize_rj', 'Normalize RJ Data', image_name) as stage:
+        matches = matches if matches is not None else matchChunks(raw_data, 'RJ', word_data)
+        invoice_raw_info, invoice_info = combineChunks(matches, 'RJ')
+        stage.count('fields', len(invoice_info))
+    return invoice_raw_info, invoice_info
+
+
+def normalizeSPData(raw_data, image_name, timings=None, word_data=None, matches=None):
+    # matches, when given, are the fields escalateOcr already read from raw_data
+    with MeasureStage(timings, 'normalize_sp', 'Normalize SP Data', image_name) as stage:
+        matches = matches if matches is not None else matchChunks(raw_data, 'SP', word_data)
+        invoice_raw_info, invoice_info = combineChunks(matches, 'SP')
+        stage.count('fields', len(invoice_info))
+    return invoice_raw_info, invoice_info
+
+
+NORMALIZERS = {
+    'RJ': normalizeRJData,
+    'SP': normalizeSPData,
+}
+
+
+def invoiceCity(image_name):
+    return 'SP' if 'SP' in image_name else 'RJ' if 'RJ' in image_name else None
+
+
+def invoiceName(source):
+    if isinstance(source, PdfPages):
+        source = source.source
+    return os.path.splitext(os.path.basename(source))[0] if isinstance(source, str) else 'invoice'
+
+
+def pageName(name, page):
+    # The first page keeps the PDF name, so single invoice PDFs produce the same files as before
+    return name if page == 1 else fr'{name}_p{page:03d}'
+
+
+def pageImage(source, image_name, timings, page, checkpoint):
+    # The 500 DPI render is the slowest stage to redo, so a job that is retried reads it back
+    # from the PNG its earlier attempt left in ./processing
+    if checkpoint is not None and checkpoint.load('image') is not None:
+        with MeasureStage(timings, 'restore_image', 'Restore Image', image_name):
+            img = cv2.imread(checkpoint.load('image'), cv2.IMREAD_GRAYSCALE)
+        if img is not None:
+            return img
+
+    img = convertPDF2Image(source, image_name, timings=timings, page=page)
+    if checkpoint is not None and CHECKPOINT_IMAGES:
+        with MeasureStage(timings, 'checkpoint_image', 'Checkpoint Image', image_name):
+            os.makedirs(checkpoint.directory, exist_ok=True)
+            image_path = os.path.join(checkpoint.directory, fr'page_{page:03d}.png')
+            cv2.imwrite(image_path, img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            checkpoint.save('image', image_path)
+    return img
+
+
+def pageRois(img, city, image_name, timings, checkpoint, layouts):
+    # Returns the regions of the page and whether they came from a full detection
+    boxes = checkpoint.load('boxes') if checkpoint is not None else None
+    if boxes is not None:
+        return [cropRoi(img, index, tuple(bbox)) for index, bbox in boxes['rois']], boxes['detected']
+
+    roi_list = matchLayout(img, city, image_name, timings, layouts) if layouts is not None else None
+    detected = roi_list is None
+    if detected:
+        contours = markRegion(img, image_name, timings)
+        roi_list = extractContours(contours, img, image_name, timings)
+    if ROI_FILTER and len(roi_list) > 0:
+        layout_fields = None if detected else layouts.fieldFlags(city, RENDER_DPI)
+        roi_list = classifyRois(roi_list, city, image_name, timings, layout_fields)
+    if checkpoint is not None:
+        checkpoint.save('boxes', {'detected': detected, 'rois': [[roi.index, list(roi.bbox)] for roi in roi_list]})
+    return roi_list, detected
+
+
+def extractInvoice(source, name=None, city=None, timings=None, page=1, checkpoint=None, layouts=None):
+    # Runs the whole pipeline on one page of a PDF path, the PDF bytes or an open PdfPages and
+    # returns the invoice instead of writing files. The city comes from the name (SP_/RJ_
+    # prefix) unless given; without one the invoice is not transcribed and invoice_info stays None.
+    # With a PageCheckpoint the stages an earlier attempt completed are not run again. With a
+    # LayoutRegistry the page is matched against its learned layouts and may add one to it;
+    # without, nothing is read or written outside the call.
+    name = name if name is not None else invoiceName(source)
+    if not isinstance(source, PdfPages):
+        with PdfPages(source) as pages:
+            return extractInvoice(pages, name, city, timings, page, checkpoint, layouts)
+    city = city if city is not None else invoiceCity(name)
+    timings = timings if timings is not None else []
+    result = {'name': name, 'page': page, 'invoice_city': city, 'invoice_info': None, 'raw': [], 'roi_text': [], 'text_source': None, 'timings': timings}
+    if city not in NORMALIZERS:
+        return result
+
+    detected = False
+    word_data = None
+    matches = None
+    saved_text = checkpoint.load('text') if checkpoint is not None else None
+    if saved_text is not None:
+        print(fr'Transcription restored from checkpoint - File {name}')
+        inc('nfe_checkpoint_resumes_total', {'stage': 'text'})
+        transc_data = saved_text['text']
+        word_data = saved_text.get('words')
+        result['text_source'] = saved_text['source']
+    else:
+        transc_data = extractTextLayer(source, name, timings, page) if TEXT_LAYER else None
+        result['text_source'] = 'text_layer'
+        if transc_data is None:
+            img = pageImage(source, name, timings, page, checkpoint)
+            roi_list, detected = pageRois(img, city, name, timings, checkpoint, layouts)
+            word_data = []
+            if OCR_TIERED:
+                transc_data = extractTxtFromImage(roi_list, name, timings, word_data, preprocess=fastRoi)
+                transc_data, matches = escalateOcr(roi_list, transc_data, word_data, city, name, timings)
+            else:
+                transc_data = extractTxtFromImage(roi_list, name, timings, word_data)
+            result['text_source'] = 'ocr'
+        if checkpoint is not None:
+            checkpoint.save('text', {'source': result['text_source'], 'text': transc_data, 'words': word_data})
+    if len(transc_data) > 0:
+        result['raw'], result['invoice_info'] = NORMALIZERS[city](transc_data, name, timings, word_data, matches)
+        # A page that needed full detection and still produced most fields becomes the city's layout
+        learn = detected and layouts is not None and len(result['invoice_info']) >= LAYOUT_MIN_FIELDS
+        if learn and not layouts.hasTemplate(city, RENDER_DPI):
+            layouts.learn(city, RENDER_DPI, img, [roi.bbox for roi in roi_list], fieldChunks(transc_data, city))
+            print(fr'Layout learned for {city} - File {name}')
+    result['roi_text'] = transc_data
+    return result
+
+
+def extractPages(source, name=None, city=None, layouts=None):
+    # Every page of a PDF is its own invoice, so bundles of concatenated invoices are fully
+    # extracted. Pages are rendered and transcribed one at a time and yielded as they finish.
+    name = name if name is not None else invoiceName(source)
+    city = city if city is not None else invoiceCity(name)
+    with PdfPages(source) as pages:
+        for page in range(1, pages.count + 1):
+            yield extractInvoice(pages, pageName(name, page), city, page=page, layouts=layouts)
+
+
+def extractOne(item):
+    source, name, city = item
+    results = []
+    try:
+        for result in extractPages(source, name, city):
+            results.append(result)
+    except Exception as err:
+        results.append({'name': name if name is not None else invoiceName(source), 'error': str(err)})
+    return results
+
+
+def extractMany(sources, workers=WORKERS):
+    # sources holds PDF paths, PDF bytes or (source, name, city) tuples. PDFs run on a process
+    # pool and the invoices of each one (one per page) are yielded as soon as it finishes, not in
+    # input order; a failure yields {'name', 'error'} instead of stopping the batch. A PDF that
+    # crashes its worker (poppler segfault, OOM kill) breaks the whole pool: the PDFs that were
+    # in flight then run again one at a time at the end, and only the one that crashes again
+    # yields the error.
+    workers = max(1, workers)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    in_flight = {}
+    suspects = []
+    try:
+        for item in sources:
+            if not isinstance(item, tuple):
+                item = (item, None, None)
+            in_flight[executor.submit(extractOne, item)] = item
+            if len(in_flight) >= 2 * workers:
+                results, broken = collectFinished(in_flight, suspects)
+                yield from results
+                if broken:
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=workers)
+        while in_flight:
+            results, broken = collectFinished(in_flight, suspects)
+            yield from results
+        executor.shutdown(wait=False)
+
+        for item in suspects:
+            executor = ProcessPoolExecutor(max_workers=1)
+            try:
+                results = executor.submit(extractOne, item).result()
+            except BrokenProcessPool as err:
+                source, name, city = item
+                results = [{'name': name if name is not None else invoiceName(source), 'error': fr'worker crashed - {err}'}]
+            executor.shutdown(wait=False)
+            yield from results
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def collectFinished(in_flight, suspects):
+    # Results of the finished futures of extractMany, removed from in_flight. When the pool
+    # broke every future of it fails, so all of them are waited for and their sources moved
+    # to suspects; returns (results, whether the pool broke)
+    done, pending = wait(in_flight, return_when=FIRST_COMPLETED)
+    if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+        done, pending = wait(in_flight, return_when=ALL_COMPLETED)
+    results = []
+    broken = False
+    for future in done:
+        item = in_flight.pop(future)
+        if isinstance(future.exception(), BrokenProcessPool):
+            suspects.append(item)
+            broken = True
+        else:
+            results += future.result()
+    return results, broken
+
+
+def processInvoice(file_name):
+    # Every completed stage is recorded in the job journal, so when this process crashes or is
+    # killed the next attempt resumes from there; pages already saved are skipped
+    job_journal.start(file_name)
+    pdf_path = fr'./input/{file_name}.pdf'
+
+    try:
+        cache_key = None
+        with PdfPages(pdf_path) as pages:
+            for page in range(1, pages.count + 1):
+                page_name = pageName(file_name, page)
+                checkpoint = PageCheckpoint(job_journal, file_name, page, fr'./processing/{file_name}')
+                if checkpoint.load('saved'):
+                    continue
+                timings = []
+                if result_cache.isEnabled():
+                    with MeasureStage(timings, 'cache_lookup', 'Cache Lookup', page_name) as stage:
+                        if cache_key is None:
+                            cache_key = result_cache.keyFor(pdf_path)
+                        entry = result_cache.load(result_cache.pageKey(cache_key, page))
+                        inc('nfe_cache_lookups_total', {'result': 'hit' if entry is not None else 'miss'})
+                        stage.note = ' (hit)' if entry is not None else ' (miss)'
+                    if entry is not None:
+                        saveProcessResult(entry['raw'], entry['invoice_info'], page_name, timings=timings, pdf_name=file_name, page=page)
+                        checkpoint.save('result', True)
+                        inc('nfe_invoices_total', {'status': 'ok', 'source': 'cache'})
+                        checkpoint.complete()
+                        continue
+
+                result = extractInvoice(pages, page_name, invoiceCity(file_name), timings, page, checkpoint, layout_registry if LAYOUT_CACHE else None)
+                if result['invoice_info'] is not None:
+                    page_key = result_cache.pageKey(cache_key, page) if cache_key is not None else None
+                    saveProcessResult(result['raw'], result['invoice_info'], page_name, roi_text=result['roi_text'], cache_key=page_key, timings=timings, pdf_name=file_name, page=page)
+                    checkpoint.save('result', True)
+                    inc('nfe_invoices_total', {'status': 'ok', 'source': result['text_source']})
+                else:
+                    inc('nfe_invoices_total', {'status': 'no_result', 'source': result['text_source'] or 'none'})
+                checkpoint.complete()
+    except Exception as err:
+        inc('nfe_invoices_total', {'status': 'failed', 'source': 'none'})
+        job_journal.fail(file_name, str(err))
+        raise
+
+    # The PDF counts as processed once its first page produced a result
+    job_journal.finish(file_name, 'done' if job_journal.checkpoints(file_name, 1).get('result') else 'no_result')
+    shutil.rmtree(fr'./processing/{file_name}', ignore_errors=True)
+
+
+def saveProcessResult(result_raw_obj, result_obj, image_name, roi_text=None, cache_key=None, timings=None, pdf_name=None, page=1):
+    with MeasureStage(timings, 'save_result', 'Save Result', image_name):
+        if cache_key is not None:
+            entry = {'invoice_info': result_obj, 'raw': result_raw_obj}
+            if CACHE_ROI_TEXT and roi_text is not None:
+                entry['roi_text'] = roi_text
+            result_cache.store(cache_key, entry)
+
+        output_sink.store(image_name, pdf_name or image_name, page, result_raw_obj, result_obj)
+
+    printTimingReport(image_name, timings or [])
+    if result_cache.isEnabled():
+        stats = result_cache.stats()
+        print(fr'Result cache - hits {stats.get("hits", 0)} / misses {stats.get("misses", 0)} / evictions {stats.get("evictions", 0)}')
+
+
+def submitInvoice(scheduler, name):
+    # The journal refuses invoices already done, that had nothing to extract or used all their
+    # attempts, unless the PDF was replaced
+    if not job_journal.queue(name, pdfFingerprint(fr'./input/{name}.pdf'), output_sink.resultExists(name)):
+        if job_journal.job(name)['status'] == 'failed':
+            # The rendered pages of an invoice given up are not needed for any retry
+            shutil.rmtree(fr'./processing/{name}', ignore_errors=True)
+        return False
+    return scheduler.submit(name)
 
 
 if __name__ == "__main__":
+    if METRICS_PORT > 0:
+        enableForwarding()
+        startMetricsServer(METRICS_PORT)
+    preloadEngines(OCR_THREADS, ('full', 'header') if ROI_FILTER else ('full',))
+    scheduler = InvoiceScheduler(processInvoice, WORKERS, FILE_TIMEOUT, QUEUE_SIZE)
+    watcher = InputWatcher('./input', POLL_INTERVAL, RESCAN_INTERVAL)
+    now = datetime.now()
+    dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
+    print(fr'Watching ./input with {watcher.mode()} - {dt_string}')
+
+    # With NFE_OCR_CLUSTER=1 several containers share ./input: a PDF is only processed by the
+    # node it hashes to, under a claim that node renews. The others keep it in deferred, with
+    # the time its claim can expire (None: only a change of the ring moves it), and look at it
+    # again then; a PDF whose claim is finished for its current fingerprint is forgotten, the
+    # watcher reports it again when it is replaced
+    cluster = None
+    if CLUSTER:
+        cluster = ClusterCoordinator(CLAIM_DIR, NODE_ID, LEASE_SECONDS)
+        cluster.heartbeat()
+        print(fr'Cluster node {NODE_ID} - claims in {CLAIM_DIR}')
+    if OUTPUT != 'files':
+        print(fr'Writing the invoices to {OUTPUT_DIR} as {OUTPUT}')
+    last_heartbeat = time.monotonic()
+    claimed = {}
+    deferred = {}
+    # PDFs whose queueing failed (e.g. a transient OSError on a shared volume), with the time
+    # they are tried again
+    retries = {}
+
+    backlog = deque()
+    queued = set()
     while True:
-        now = datetime.now()
-        dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
-        print(fr'Cicle started - {dt_string}')
-
-        new_files = os.listdir('./input')
-        for file in new_files:
-            process_running = os.listdir('./processing')
-            file_name = os.path.splitext(file)[0]
+        for name in watcher.poll(1.0):
+            # A deferred PDF reported again was replaced or lost its result, it is checked now
+            deferred.pop(name, None)
+            retries.pop(name, None)
+            if name in watcher.done or name in queued or scheduler.isKnown(name):
+                continue
+            backlog.append(name)
+            queued.add(name)
+
+        if cluster is not None and time.monotonic() - last_heartbeat >= HEARTBEAT_INTERVAL:
+            last_heartbeat = time.monotonic()
+            ring_changed = cluster.heartbeat()
+            for name in cluster.renew(list(claimed)):
+                print(fr'Claim taken over by another node, dropping - File {name}')
+                scheduler.cancel(name)
+                del claimed[name]
+            now = time.time()
+            for name, expires in list(deferred.items()):
+                if ring_changed or (expires is not None and now >= expires):
+                    del deferred[name]
+                    if name not in queued:
+                        backlog.append(name)
+                        queued.add(name)
+
+        for name, retry_at in list(retries.items()):
+            if time.monotonic() >= retry_at:
+                del retries[name]
+                if name not in queued:
+                    backlog.append(name)
+                    queued.add(name)
+
+        while backlog and not scheduler.isFull():
+            name = backlog.popleft()
+            queued.discard(name)
+            if name in watcher.done:
+                continue
             try:
-                if fr'{file_name}.json' in new_files:
-                    continue
-                elif fr'{file_name}' not in process_running:
-                    os.mkdir(fr'./processing/{file_name}')
-                process_running = os.listdir('./processing')
-                for proc in process_running:
-                    proc_dir = os.listdir(fr'./processing/{proc}') if proc != '.DS_Store' else [False]
-                    if len(proc_dir) == 0:
-                        convertPDF2Image(proc)
+                if cluster is not None and name not in claimed:
+                    fingerprint = pdfFingerprint(fr'./input/{name}.pdf')
+                    if not cluster.isOwner(name):
+                        claim = cluster.claimInfo(name)
+                        if claim is None or claim['state'] == 'running' or claim['fingerprint'] != fingerprint:
+                            deferred[name] = None
+                        continue
+                    if not cluster.claim(name, fingerprint, output_sink.resultExists(name)):
+                        # Finished by another node, only a replaced PDF is looked at again
+                        claim = cluster.claimInfo(name)
+                        if claim is not None and claim['state'] == 'running':
+                            deferred[name] = claim['mtime'] + LEASE_SECONDS
+                        continue
+                    claimed[name] = fingerprint
+                if submitInvoice(scheduler, name):
+                    print(fr'Queued - File {name}')
+                elif name in claimed:
+                    cluster.finish(name, claimed.pop(name), job_journal.job(name)['status'])
             except Exception as err:
-                print(fr'Error when running {file} file transcript. - {err}')
-        time.sleep(30)
+                # Tried again after RETRY_SECONDS while the PDF exists; a claim this node took
+                # is not renewed meanwhile, so after the lease another node may take it over
+                claimed.pop(name, None)
+                print(fr'Error when running {name} file transcript. - {err}')
+                if os.path.exists(fr'./input/{name}.pdf'):
+                    retries[name] = time.monotonic() + RETRY_SECONDS
+
+        for name, exitcode in scheduler.poll():
+            if exitcode is None:
+                job_journal.fail(name, fr'timed out after {FILE_TIMEOUT}s')
+            elif exitcode < 0:
+                job_journal.fail(name, fr'killed by signal {-exitcode}')
+            if exitcode != 0:
+                inc('nfe_worker_failures_total', {'reason': 'timeout' if exitcode is None else 'crash'})
+                # Retried from its checkpoints until the journal gives up on it
+                if name not in queued:
+                    backlog.append(name)
+                    queued.add(name)
+                continue
+            if name in claimed:
+                cluster.finish(name, claimed.pop(name), job_journal.job(name)['status'])
+            if job_journal.job(name)['status'] == 'done':
+                watcher.done.add(name)
+        try:
+            output_sink.flush()
+        except Exception as err:
+            # The records stay in the journal and the next cycle tries again
+            print(fr'Error when writing the batch output. - {err}')
@@ -0,0 +1,189 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+OCR_BACKEND = os.environ.get('NFE_OCR_BACKEND', 'auto')
+OCR_THREADS = int(os.environ.get('NFE_OCR_OCR_THREADS', 4))
+OCR_LANG = 'eng+por'
+OCR_DPI = 150
+# (lang, dpi, page segmentation mode) of every kind of engine. header is the quick pass that
+# only has to recognize the label line of a region: one language and a single text block.
+OCR_PROFILES = {
+    'full': (OCR_LANG, OCR_DPI, None),
+    'header': ('por', OCR_DPI, 6),
+}
+
+# Several tesseract engines run side by side, each one should stay on a single core.
+# Must be set before libtesseract (and its OpenMP runtime) is loaded.
+if OCR_THREADS > 1:
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+import pytesseract
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+
+def dataToText(data):
+    # Rebuilds image_to_string's text from image_to_data (one line per text line, a blank line
+    # between paragraphs) along with every word and its confidence
+    lines = []
+    words = []
+    last_line = None
+    for idx, word in enumerate(data['text']):
+        word = word.strip()
+        if not word:
+            continue
+        line = (data['block_num'][idx], data['par_num'][idx], data['line_num'][idx])
+        if line == last_line:
+            lines[-1] += ' ' + word
+        else:
+            if last_line is not None and line[:2] != last_line[:2]:
+                lines.append('')
+            lines.append(word)
+            last_line = line
+        words.append((word, float(data['conf'][idx])))
+    return ('\n'.join(lines) + '\n' if lines else ''), words
+
+
+class PytesseractEngine:
+    # Forks the tesseract binary and reloads the traineddata on every call
+    name = 'pytesseract'
+
+    def __init__(self, lang=OCR_LANG, dpi=OCR_DPI, psm=None):
+        self.lang = lang
+        self.dpi = dpi
+        self.psm = psm
+
+    def configFor(self, dpi, psm):
+        psm = psm if psm is not None else self.psm
+        config = fr'-l {self.lang} --dpi {dpi or self.dpi}'
+        if psm is not None:
+            config += fr' --psm {psm}'
+        return config
+
+    def imageToString(self, img, dpi=None, psm=None):
+        return pytesseract.image_to_string(img, config=self.configFor(dpi, psm))
+
+    def imageToData(self, img, dpi=None, psm=None):
+        return dataToText(pytesseract.image_to_data(img, config=self.configFor(dpi, psm), output_type=pytesseract.Output.DICT))
+
+    def close(self):
+        pass
+
+
+class TesserocrEngine:
+    # Keeps one libtesseract instance with the language models loaded for its whole life.
+    # Not thread safe, every thread must own its engine.
+    name = 'tesserocr'
+
+    def __init__(self, lang=OCR_LANG, dpi=OCR_DPI, psm=None):
+        self.api = tesserocr.PyTessBaseAPI(lang=lang)
+        self.dpi = dpi
+        self.psm = psm if psm is not None else tesserocr.PSM.AUTO
+
+    def imageToString(self, img, dpi=None, psm=None):
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        height, width = img.shape[:2]
+        bytes_per_pixel = 1 if img.ndim == 2 else img.shape[2]
+        self.api.SetPageSegMode(psm if psm is not None else self.psm)
+        self.api.SetImageBytes(img.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+        self.api.SetSourceResolution(dpi or self.dpi)
+        return self.api.GetUTF8Text()
+
+    def imageToData(self, img, dpi=None, psm=None):
+        # The word confidences come from the recognition GetUTF8Text already ran
+        text = self.imageToString(img, dpi, psm)
+        return text, [(word, float(conf)) for word, conf in self.api.MapWordConfidences()]
+
+    def close(self):
+        self.api.End()
+
+
+def createEngine(backend=OCR_BACKEND, profile='full'):
+    lang, dpi, psm = OCR_PROFILES[profile]
+    if backend == 'tesserocr' or (backend == 'auto' and tesserocr is not None):
+        if tesserocr is None:
+            raise RuntimeError('NFE_OCR_BACKEND is tesserocr but the tesserocr package is not installed')
+        return TesserocrEngine(lang, dpi, psm)
+    elif backend in ('pytesseract', 'auto'):
+        return PytesseractEngine(lang, dpi, psm)
+    raise ValueError(fr'Unknown OCR backend {backend}')
+
+
+local_engines = threading.local()
+pool_lock = threading.Lock()
+pool = None
+pool_key = None
+preloaded = {}
+
+
+def getEngine(profile='full'):
+    engines = getattr(local_engines, 'engines', None)
+    if engines is None:
+        engines = {}
+        local_engines.engines = engines
+    engine = engines.get(profile)
+    if engine is None:
+        with pool_lock:
+            spare = preloaded.get(profile)
+            engine = spare.pop() if spare else None
+        if engine is None:
+            engine = createEngine(profile=profile)
+        engines[profile] = engine
+    return engine
+
+
+def preloadEngines(threads=OCR_THREADS, profiles=('full', 'header')):
+    # Called by the process that forks one worker per invoice, before forking: the engines are
+    # built once here and every child takes them over with the language models already loaded
+    # (shared copy-on-write) instead of loading them again for each invoice. The caller must
+    # not run OCR itself, its OCR threads would take the engines meant for the children.
+    with pool_lock:
+        for profile in profiles:
+            engines = preloaded.setdefault(profile, [])
+            while len(engines) < max(1, threads):
+                engines.append(createEngine(profile=profile))
+
+
+def imageToString(item, profile='full'):
+    # item is an image, or (image, dpi, psm) for an image prepared with its own resolution and
+    # page segmentation mode
+    if isinstance(item, tuple):
+        img, dpi, psm = item
+        return getEngine(profile).imageToString(img, dpi, psm)
+    return getEngine(profile).imageToString(item)
+
+
+def imageToData(item, profile='full'):
+    # Same as imageToString, returning (text, [(word, confidence), ...])
+    if isinstance(item, tuple):
+        img, dpi, psm = item
+        return getEngine(profile).imageToData(img, dpi, psm)
+    return getEngine(profile).imageToData(item)
+
+
+def getPool(threads):
+    global pool, pool_key
+    # The pool and its per-thread engines live as long as the process, a forked child builds its own
+    key = (os.getpid(), threads)
+    with pool_lock:
+        if pool is None or pool_key != key:
+            if pool is not None and pool_key[0] == key[0]:
+                pool.shutdown(wait=False)
+            pool = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix='ocr')
+            pool_key = key
+        return pool
+
+
+def ocrImages(images, threads=OCR_THREADS, preprocess=None, profile='full', with_data=False):
+    # map keeps the results in the same order as images; preprocess runs on the OCR threads too
+    # and may return an image or (image, dpi, psm). with_data returns (text, words) per image.
+    transcribe = imageToData if with_data else imageToString
+    if preprocess is None:
+        return list(getPool(threads).map(lambda img: transcribe(img, profile), images))
+    return list(getPool(threads).map(lambda img: transcribe(preprocess(img), profile), images))
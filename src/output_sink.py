@@ -0,0 +1,246 @@
+import json
+import os
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Where the extracted invoices go. FileSink writes the .json and .txt of every invoice next to
+# its PDF, as always. BatchSink appends every invoice as one flat record to large JSON lines
+# or Parquet files, for millions of invoices that should not become millions of small files.
+
+PARTY_FIELDS = ['doc_number', 'city_number', 'state_number', 'main_name', 'sec_name', 'phone', 'address',
+                'zip_code', 'city', 'state', 'email']
+MONEY_FIELDS = ['invoice_value_raw', 'invoice_value_liq', 'invoice_deduc', 'invoice_discount', 'invoice_calc_base_tax',
+                'invoice_iss_tax', 'invoice_iptu_credit', 'invoice_tax_inss', 'invoice_tax_irrf', 'invoice_tax_csll',
+                'invoice_tax_cofins', 'invoice_tax_pis-pasep', 'invoice_tax_deductions', 'invoice_tax_calc_base',
+                'invoice_tax_iss', 'invoice_tax_credit', 'invoice_tax_tribute_value']
+
+# (column, kind, path in invoice_info) of every field; every field but the city also gets a
+# <column>_confidence column
+FIELD_COLUMNS = (
+    [('invoice_num', 'string', ('invoice_num',)),
+     ('invoice_creation', 'timestamp', ('invoice_creation',)),
+     ('invoice_verif_cod', 'string', ('invoice_verif_cod',)),
+     ('invoice_service', 'string', ('invoice_service',)),
+     ('invoice_order_number', 'string', ('invoice_description', 'order_number')),
+     ('invoice_aliq_tax', 'percent', ('invoice_aliq_tax',)),
+     ('invoice_tax_aliq', 'percent', ('invoice_tax_aliq',)),
+     ('invoice_tax_service_city', 'string', ('invoice_tax_service_city',)),
+     ('invoice_tax_work_num', 'string', ('invoice_tax_work_num',))]
+    + [(field.replace('-', '_'), 'money', (field,)) for field in MONEY_FIELDS]
+    + [(fr'{party}_{field}', 'string', (party, field)) for party in ('invoice_provider', 'invoice_client') for field in PARTY_FIELDS]
+)
+
+# (precision, scale) of the decimal columns; a value that does not fit its column is written as null
+DECIMAL_SIZES = {'money': (18, 2), 'percent': (7, 4)}
+
+
+def writeAtomic(path, text):
+    # Readers of ./input only ever see complete files: the content is written and synced under
+    # a temporary name, then renamed over the final one
+    tmp_path = fr'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as out_file:
+        out_file.write(text)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def parseDecimal(text):
+    # '1.234,56' -> Decimal('1234.56'), '5,00 %' -> Decimal('5.00')
+    if not text:
+        return None
+    try:
+        return Decimal(text.replace('%', '').strip().replace('.', '').replace(',', '.'))
+    except InvalidOperation:
+        return None
+
+
+def fitDecimal(value, precision, scale):
+    # The value rounded to scale digits when it has more, None when it does not fit decimal(precision, scale)
+    if value is None or not value.is_finite():
+        return None
+    if value.as_tuple().exponent < -scale:
+        try:
+            value = value.quantize(Decimal(1).scaleb(-scale))
+        except InvalidOperation:
+            return None
+    integer_digits = len(value.as_tuple().digits) + min(value.as_tuple().exponent, 0)
+    if integer_digits > precision - scale:
+        return None
+    return value
+
+
+def parseTimestamp(text):
+    try:
+        return datetime.strptime(text, '%d/%m/%Y %H:%M:%S').isoformat()
+    except (TypeError, ValueError):
+        return None
+
+
+def fieldValue(invoice_info, path):
+    node = invoice_info.get(path[0])
+    if len(path) > 1 and isinstance(node, dict):
+        node = node.get(path[1])
+    if isinstance(node, dict):
+        return node.get('value'), node.get('confidence')
+    return node, None
+
+
+def invoiceRecord(name, pdf_name, page, invoice_info):
+    # Flat record of one invoice; money and percentages are decimals kept as strings so JSON
+    # does not turn them into floats, the emission date is ISO 8601
+    record = {'name': name, 'pdf': pdf_name, 'page': page, 'invoice_city': fieldValue(invoice_info, ('invoice_city',))[0]}
+    for column, kind, path in FIELD_COLUMNS:
+        value, confidence = fieldValue(invoice_info, path)
+        if kind in ('money', 'percent'):
+            decimal = fitDecimal(parseDecimal(value), *DECIMAL_SIZES[kind])
+            if value and decimal is None:
+                print(fr'{column} value {value!r} is not a decimal({DECIMAL_SIZES[kind][0]}, {DECIMAL_SIZES[kind][1]}), written as null - File {name}')
+            value = str(decimal) if decimal is not None else None
+        elif kind == 'timestamp':
+            value = parseTimestamp(value)
+        record[column] = value
+        record[fr'{column}_confidence'] = confidence
+    return record
+
+
+def arrowSchema():
+    types = {'string': pa.string(), 'timestamp': pa.timestamp('s'), 'money': pa.decimal128(*DECIMAL_SIZES['money']),
+             'percent': pa.decimal128(*DECIMAL_SIZES['percent'])}
+    fields = [pa.field('name', pa.string()), pa.field('pdf', pa.string()), pa.field('page', pa.int32()),
+              pa.field('invoice_city', pa.string())]
+    for column, kind, path in FIELD_COLUMNS:
+        fields.append(pa.field(column, types[kind]))
+        fields.append(pa.field(fr'{column}_confidence', pa.float64()))
+    return pa.schema(fields)
+
+
+def arrowValue(kind, value):
+    if value is None:
+        return None
+    if kind in ('money', 'percent'):
+        return Decimal(value)
+    if kind == 'timestamp':
+        return datetime.fromisoformat(value)
+    return value
+
+
+class FileSink:
+
+    def __init__(self, path):
+        self.path = path
+
+    def store(self, name, pdf_name, page, result_raw_obj, result_obj):
+        # The .json marks the invoice as done, so it is written last
+        writeAtomic(fr'{self.path}/{name}.txt', ''.join(el + '\n' for el in result_raw_obj))
+        writeAtomic(fr'{self.path}/{name}.json', json.dumps(result_obj, indent=2, sort_keys=True, ensure_ascii=False))
+
+    def resultExists(self, name):
+        return os.path.exists(fr'{self.path}/{name}.json')
+
+    def flush(self):
+        pass
+
+
+class BatchSink:
+    # The workers put their records in the outbox of the job journal; flush(), from the main
+    # loop, moves them to the output files. jsonl appends every batch to the open file and
+    # fsyncs it, then drops the batch from the outbox in the same transaction that records the
+    # new file size; after a crash the file is cut back to that size, so no record is lost or
+    # written twice. A file is closed once it reaches roll_bytes or is roll_seconds old.
+    # parquet keeps the records in the outbox until that size or age and writes them as one
+    # file, named after the first record so a rewrite after a crash replaces it. A batch that
+    # pyarrow refuses goes to rejected_<first record>.jsonl instead, so it cannot block the outbox.
+    # The raw OCR text (the .txt of FileSink) is not kept.
+
+    def __init__(self, path, file_format, roll_bytes, roll_seconds, journal, prefix):
+        if file_format not in ('jsonl', 'parquet'):
+            raise ValueError(fr'Unknown output format {file_format}')
+        if file_format == 'parquet' and pa is None:
+            raise RuntimeError('NFE_OCR_OUTPUT is parquet but the pyarrow package is not installed')
+        self.path = path
+        self.file_format = file_format
+        self.roll_bytes = roll_bytes
+        self.roll_seconds = roll_seconds
+        self.journal = journal
+        self.prefix = prefix
+        self.recovered = False
+
+    def store(self, name, pdf_name, page, result_raw_obj, result_obj):
+        self.journal.saveResult(pdf_name, page, invoiceRecord(name, pdf_name, page, result_obj))
+
+    def resultExists(self, name):
+        # Records are never taken back out of the batch files
+        return True
+
+    def filePath(self, first_id):
+        return os.path.join(self.path, fr'{self.prefix}_{first_id:012d}.{self.file_format}')
+
+    def flush(self):
+        os.makedirs(self.path, exist_ok=True)
+        if self.file_format == 'jsonl':
+            self.flushLines(self.journal.pendingResults())
+            return
+        size, age = self.journal.pendingSize()
+        if size > 0 and (size >= self.roll_bytes or age >= self.roll_seconds):
+            self.writeParquet(self.journal.pendingResults())
+
+    def flushLines(self, rows):
+        sink_file = self.journal.sinkFile()
+        if not self.recovered:
+            if sink_file is not None and os.path.exists(sink_file['path']) and os.path.getsize(sink_file['path']) > sink_file['size']:
+                print(fr'Cutting {sink_file["path"]} back to its last complete batch')
+                os.truncate(sink_file['path'], sink_file['size'])
+            self.recovered = True
+
+        if sink_file is not None and time.time() - sink_file['created'] >= self.roll_seconds:
+            self.journal.commitResults(0, None)
+            sink_file = None
+        if not rows:
+            return
+        if sink_file is None:
+            sink_file = {'path': self.filePath(rows[0][0]), 'size': 0, 'created': time.time()}
+
+        data = ''.join(json.dumps(record, ensure_ascii=False, sort_keys=True) + '\n' for row_id, record in rows).encode('utf-8')
+        with open(sink_file['path'], 'r+b' if sink_file['size'] > 0 else 'wb') as out_file:
+            out_file.seek(sink_file['size'])
+            out_file.truncate()
+            out_file.write(data)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        sink_file['size'] += len(data)
+        self.journal.commitResults(rows[-1][0], sink_file if sink_file['size'] < self.roll_bytes else None)
+
+    def writeParquet(self, rows):
+        columns = {'name': [], 'pdf': [], 'page': [], 'invoice_city': []}
+        for column, kind, path in FIELD_COLUMNS:
+            columns[column] = []
+            columns[fr'{column}_confidence'] = []
+        kinds = {column: kind for column, kind, path in FIELD_COLUMNS}
+        for row_id, record in rows:
+            for column, values in columns.items():
+                values.append(arrowValue(kinds.get(column), record.get(column)))
+
+        path = self.filePath(rows[0][0])
+        try:
+            table = pa.Table.from_pydict(columns, schema=arrowSchema())
+        except (pa.ArrowException, ValueError, TypeError) as err:
+            rejected_path = os.path.join(self.path, fr'rejected_{rows[0][0]:012d}.jsonl')
+            writeAtomic(rejected_path, ''.join(json.dumps(record, ensure_ascii=False, sort_keys=True) + '\n' for row_id, record in rows))
+            self.journal.commitResults(rows[-1][0], None)
+            print(fr'Parquet refused {len(rows)} invoices, set aside in {rejected_path} - {err}')
+            return
+        tmp_path = fr'{path}.tmp'
+        pq.write_table(table, tmp_path)
+        with open(tmp_path, 'rb') as out_file:
+            os.fsync(out_file.fileno())
+        os.replace(tmp_path, path)
+        self.journal.commitResults(rows[-1][0], None)
+        print(fr'Wrote {len(rows)} invoices to {path}')
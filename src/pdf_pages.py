@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+import numpy as np
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+
+class PdfPages:
+    # Page by page access to one PDF, for bundles of many invoices: poppler rasterizes only the
+    # requested page and the pixels are copied into an array kept per DPI, so memory stays the
+    # same whatever the page count. An image returned by render() is overwritten by the next
+    # render() at the same DPI. PDF bytes are written once to a temporary file.
+
+    def __init__(self, source):
+        self.source = source
+        self.path = None
+        self.tmp_file = None
+        self.count = 0
+        self.buffers = {}
+
+    def __enter__(self):
+        if isinstance(self.source, (bytes, bytearray)):
+            self.tmp_file = tempfile.NamedTemporaryFile(suffix='.pdf')
+            self.tmp_file.write(self.source)
+            self.tmp_file.flush()
+            self.path = self.tmp_file.name
+        else:
+            self.path = os.fspath(self.source)
+        self.count = int(pdfinfo_from_path(self.path)['Pages'])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.tmp_file is not None:
+            self.tmp_file.close()
+            self.tmp_file = None
+        self.buffers = {}
+        return False
+
+    def render(self, page, dpi):
+        pil_page = convert_from_path(self.path, dpi, first_page=page, last_page=page, grayscale=True)[0].convert('L')
+        pixels = np.asarray(pil_page)
+        buffer = self.buffers.get(dpi)
+        if buffer is None or buffer.shape != pixels.shape:
+            buffer = np.empty(pixels.shape, dtype=np.uint8)
+            self.buffers[dpi] = buffer
+        np.copyto(buffer, pixels)
+        pil_page.close()
+        return buffer
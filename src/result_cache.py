@@ -0,0 +1,131 @@
+import fcntl
+import hashlib
+import json
+import os
+
+
+class ResultCache:
+    # Content addressed store of pipeline results: the key is the SHA-256 of the PDF bytes
+    # plus the pipeline/config version, so a re-sent invoice skips rasterize/OCR/normalize and
+    # any change of version or config starts from a clean slate.
+    # Entries are plain files shared by every worker process; the LRU order is the file mtime,
+    # refreshed on every hit.
+
+    def __init__(self, path, max_bytes, version):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = version
+
+    def isEnabled(self):
+        return self.max_bytes > 0
+
+    def keyFor(self, pdf_path):
+        digest = hashlib.sha256()
+        with open(pdf_path, 'rb') as pdf_file:
+            for chunk in iter(lambda: pdf_file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        digest.update(self.version.encode('utf-8'))
+        return digest.hexdigest()
+
+    def pageKey(self, key, page):
+        # The first page uses the PDF key itself, so entries of single invoice PDFs stay valid
+        return key if page == 1 else fr'{key}-p{page}'
+
+    def entryPath(self, key):
+        return os.path.join(self.path, fr'{key}.json')
+
+    def load(self, key):
+        if not self.isEnabled():
+            return None
+        entry_path = self.entryPath(key)
+        try:
+            with open(entry_path, 'r') as entry_file:
+                entry = json.load(entry_file)
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            self.recordStat('misses')
+            return None
+        self.recordStat('hits')
+        return entry
+
+    def store(self, key, entry):
+        if not self.isEnabled():
+            return
+        os.makedirs(self.path, exist_ok=True)
+        entry_path = self.entryPath(key)
+        tmp_path = fr'{entry_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as entry_file:
+            json.dump(entry, entry_file, ensure_ascii=False)
+        try:
+            old_size = os.path.getsize(entry_path)
+        except OSError:
+            old_size = 0
+        new_size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, entry_path)
+
+        # The running total avoids listing the cache on every store; it is only scanned the
+        # first time and when the total goes over max_bytes, which also corrects any drift
+        def addEntry(stats):
+            if 'bytes' not in stats:
+                stats['bytes'] = self.scanSize()
+            else:
+                stats['bytes'] += new_size - old_size
+            if stats['bytes'] > self.max_bytes:
+                stats['bytes'], evicted = self.evict()
+                stats['evictions'] = stats.get('evictions', 0) + evicted
+        self.updateStats(addEntry)
+
+    def listEntries(self):
+        entries = []
+        for file in os.listdir(self.path):
+            if not file.endswith('.json') or file == 'stats.json':
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, file))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+        return entries
+
+    def scanSize(self):
+        return sum(size for mtime, size, file in self.listEntries())
+
+    def evict(self):
+        # Removes the least recently used entries until the cache is back to 90% of max_bytes,
+        # so the next scan is not due on the very next store. Returns (total, evicted).
+        entries = sorted(self.listEntries())
+        total = sum(size for mtime, size, file in entries)
+        evicted = 0
+        for mtime, size, file in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.path, file))
+                evicted += 1
+            except OSError:
+                pass
+            total -= size
+        return total, evicted
+
+    def recordStat(self, name):
+        def increment(stats):
+            stats[name] = stats.get(name, 0) + 1
+        self.updateStats(increment)
+
+    def updateStats(self, update):
+        # Counters and the size total are shared by all worker processes, the lock file
+        # serializes the updates
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'stats.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            stats = self.stats()
+            update(stats)
+            with open(os.path.join(self.path, 'stats.json'), 'w') as stats_file:
+                json.dump(stats, stats_file)
+
+    def stats(self):
+        try:
+            with open(os.path.join(self.path, 'stats.json'), 'r') as stats_file:
+                return json.load(stats_file)
+        except (OSError, ValueError):
+            return {'hits': 0, 'misses': 0, 'evictions': 0}
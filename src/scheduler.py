@@ -0,0 +1,92 @@
+import multiprocessing
+import os
+import time
+from collections import deque
+
+from metrics import flushForwarded
+
+
+def runIsolated(target, name):
+    try:
+        target(name)
+    except Exception as err:
+        print(fr'Error when running {name} file transcript. - {err}')
+        flushForwarded()
+        os._exit(1)
+    flushForwarded()
+
+
+class InvoiceScheduler:
+    # Every invoice runs in its own child process, so a PDF that crashes poppler/tesseract
+    # or hangs past the timeout only takes down its own process, never the polling loop.
+
+    def __init__(self, target, workers, timeout, max_queued):
+        self.target = target
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self.pending = deque()
+        self.running = {}
+
+    def isKnown(self, name):
+        return name in self.running or name in self.pending
+
+    def isFull(self):
+        return len(self.pending) >= self.max_queued
+
+    def isIdle(self):
+        return len(self.pending) == 0 and len(self.running) == 0
+
+    def submit(self, name):
+        if self.isKnown(name):
+            return True
+        if self.isFull():
+            return False
+        self.pending.append(name)
+        return True
+
+    def poll(self):
+        finished = []
+        now = time.monotonic()
+        for name, (proc, started) in list(self.running.items()):
+            if not proc.is_alive():
+                proc.join()
+                if proc.exitcode != 0:
+                    print(fr'Worker failed - File {name} - exit code {proc.exitcode}')
+                del self.running[name]
+                finished.append((name, proc.exitcode))
+            elif now - started > self.timeout:
+                print(fr'Worker timed out after {self.timeout}s - File {name}')
+                proc.terminate()
+                proc.join(5)
+                if proc.is_alive():
+                    proc.kill()
+                    proc.join()
+                del self.running[name]
+                finished.append((name, None))
+
+        while self.pending and len(self.running) < self.workers:
+            name = self.pending.popleft()
+            proc = multiprocessing.Process(target=runIsolated, args=(self.target, name), name=fr'nfe-{name}', daemon=True)
+            proc.start()
+            self.running[name] = (proc, time.monotonic())
+        return finished
+
+    def cancel(self, name):
+        # Drops the invoice without reporting it in poll(), killing its worker if it started
+        if name in self.pending:
+            self.pending.remove(name)
+        if name in self.running:
+            proc, started = self.running.pop(name)
+            proc.terminate()
+            proc.join(5)
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+
+    def shutdown(self):
+        self.pending.clear()
+        for name, (proc, started) in self.running.items():
+            proc.terminate()
+            proc.join()
+        self.running.clear()
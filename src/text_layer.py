@@ -0,0 +1,65 @@
+import os
+import subprocess
+import tempfile
+import xml.etree.ElementTree as ET
+
+XHTML = '{http://www.w3.org/1999/xhtml}'
+
+
+def runPdftotext(pdf_path, page):
+    completed = subprocess.run(
+        ['pdftotext', '-bbox-layout', '-f', str(page), '-l', str(page), '-enc', 'UTF-8', pdf_path, '-'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        timeout=60,
+        check=True
+    )
+    return completed.stdout
+
+
+def readPdfWords(source, page=1):
+    # Words of one page with their box in PDF points, in poppler's reading order:
+    # (line id, xMin, yMin, xMax, yMax, text). Empty when the PDF has no text layer or
+    # pdftotext is not available.
+    try:
+        if isinstance(source, (bytes, bytearray)):
+            with tempfile.NamedTemporaryFile(suffix='.pdf') as pdf_file:
+                pdf_file.write(source)
+                pdf_file.flush()
+                output = runPdftotext(pdf_file.name, page)
+        else:
+            output = runPdftotext(os.fspath(source), page)
+        root = ET.fromstring(output)
+    except (OSError, subprocess.SubprocessError, ET.ParseError):
+        return []
+
+    words = []
+    for line_id, line in enumerate(root.iter(fr'{XHTML}line')):
+        for word in line.iter(fr'{XHTML}word'):
+            text = (word.text or '').strip()
+            if text:
+                words.append((
+                    line_id,
+                    float(word.get('xMin')),
+                    float(word.get('yMin')),
+                    float(word.get('xMax')),
+                    float(word.get('yMax')),
+                    text
+                ))
+    return words
+
+
+def wordsInBoxes(words, boxes, points_to_pixels, margin=25):
+    # Rebuilds, for every box (x, y, width, height in page pixels), the text Tesseract would
+    # read from its crop: the words whose center falls inside the box plus the same margin
+    # the OCR crop uses, one line per poppler line.
+    box_text = []
+    for (x, y, lar, alt) in boxes:
+        lines = {}
+        for line_id, x_min, y_min, x_max, y_max, text in words:
+            center_x = (x_min + x_max) / 2 * points_to_pixels
+            center_y = (y_min + y_max) / 2 * points_to_pixels
+            if x - margin <= center_x <= x + lar + margin and y - margin <= center_y <= y + alt + margin:
+                lines.setdefault(line_id, []).append(text)
+        box_text.append('\n'.join(' '.join(line) for line in lines.values()))
+    return box_text